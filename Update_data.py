@@ -1,5 +1,13 @@
 from main import DataLoader
+from snapshot import ArrowSnapshot
 
 if __name__ == '__main__':
     loader = DataLoader('Sports')
-    loader.update_data(r"C:\Users\User\Documenten\Version2\Data.xlsx", 'Sports')
\ No newline at end of file
+    loader.update_data(r"C:\Users\User\Documenten\Version2\Data.xlsx", 'Sports')
+    cleaned_data = loader.clean_data(loader.read_data())
+    # Show the rows with bad data so they can be fixed in the Excel file
+    validation_report = loader.validate_data(cleaned_data)
+    if not validation_report.empty:
+        print(validation_report.to_string(index=False))
+    # Publish the refreshed data so running dashboards pick up the new version
+    ArrowSnapshot().publish(cleaned_data)
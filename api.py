@@ -0,0 +1,176 @@
+""" Local JSON API serving the analysis tables.
+
+    The tables are computed once per snapshot version and kept as encoded response bodies,
+    every response carries an ETag built from the snapshot version, the path and the format,
+    so a client sending If-None-Match gets a 304 without anything being recomputed.
+
+    Endpoints, add '?format=arrow' for an Arrow IPC stream instead of JSON:
+    - /running: RunAnalysis.unique_running_data
+    - /groups: ExerciseAnalysis.group_exercise_data
+    - /exercises: ExerciseAnalysis.unique_exercise_data
+    - /exercises/<exercise>/trend: ExerciseAnalysis.weight_trend_data
+    """
+#%%
+import json
+import time
+import zlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import pandas as pd
+import pyarrow as pa
+
+from main import DataLoader, ExerciseAnalysis, RunAnalysis, ANALYSIS_COLUMNS
+from snapshot import ArrowSnapshot
+
+CONTENT_TYPES = {'json': 'application/json', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+def encode(table: pd.DataFrame, format: str) -> bytes:
+    if format == 'arrow':
+        sink = pa.BufferOutputStream()
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+        return sink.getvalue().to_pybytes()
+    return table.to_json(orient='records', date_format='iso').encode()
+
+
+def make_etag(version: str, path: str, format: str) -> str:
+    # The path may hold any character, its CRC keeps the ETag plain ASCII
+    return f'"{version}-{zlib.crc32(path.encode()):08x}-{format}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match holds '*' or a comma separated list of ETags, weak ones (W/"...") compare equal too
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+class AnalysisTables:
+    def __init__(self, snapshot: ArrowSnapshot, check_interval: float = 1.0) -> None:
+        self.snapshot = snapshot
+        # Seconds between two looks at the snapshot pointer
+        self.check_interval = check_interval
+        self.checked_at = 0.0
+        # The version, its encoded response bodies keyed by (path, format) and its analysis,
+        # replaced as a whole so a request never mixes two versions
+        self.state: Optional[Tuple[str, Dict[Tuple[str, str], bytes], ExerciseAnalysis]] = None
+        self.lock = threading.Lock()
+
+    def current(self) -> Tuple[str, Dict[Tuple[str, str], bytes], ExerciseAnalysis]:
+        now = time.monotonic()
+        if self.state is None or now - self.checked_at > self.check_interval:
+            with self.lock:
+                version = self.snapshot.current_version()
+                if version is None:
+                    loader = DataLoader('Sports')
+                    version = self.snapshot.publish(loader.clean_data(loader.read_data()))
+                if self.state is None or version != self.state[0]:
+                    self.state = self._load(version)
+                self.checked_at = now
+        return self.state
+
+    def _load(self, version: str) -> Tuple[str, Dict[Tuple[str, str], bytes], ExerciseAnalysis]:
+        start = time.perf_counter()
+        data = self.snapshot.read_data(version, ANALYSIS_COLUMNS)
+        # Rows the analysis cannot handle are left out, the dashboard reports them
+        loader = DataLoader('Sports')
+        data = loader.quarantine(data, loader.validate_data(data))
+        exercise_analysis = ExerciseAnalysis(data)
+        tables = {
+            '/running': RunAnalysis(data).unique_running_data(),
+            '/groups': exercise_analysis.group_exercise_data(),
+            '/exercises': exercise_analysis.unique_exercise_data(),
+        }
+        bodies = {(path, format): encode(table, format) for path, table in tables.items() for format in CONTENT_TYPES}
+        logging.info(f"Precomputed the tables of snapshot {version} in {time.perf_counter() - start:.1f} s")
+        return version, bodies, exercise_analysis
+
+    def body(self, path: str, format: str) -> Tuple[str, Optional[bytes]]:
+        version, bodies, exercise_analysis = self.current()
+        key = (path, format)
+        if key not in bodies:
+            parts = path.strip('/').split('/')
+            if len(parts) != 3 or parts[0] != 'exercises' or parts[2] != 'trend':
+                return version, None
+            # The trend data is computed on the first request of an exercise and kept for this version
+            exercise_data = exercise_analysis.weight_trend_data(parts[1])
+            if exercise_data.empty:
+                return version, None
+            bodies[key] = encode(exercise_data.reset_index(drop=True), format)
+        return version, bodies[key]
+
+
+def make_handler(tables: AnalysisTables) -> Callable:
+    class AnalysisRequestHandler(BaseHTTPRequestHandler):
+        # Keep the connections open between requests and send the headers and body without delay
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            path = unquote(url.path).rstrip('/')
+            format = parse_qs(url.query).get('format', ['json'])[0]
+            if format not in CONTENT_TYPES:
+                self._send_error(400, f"Unknown format {format}, expected one of {list(CONTENT_TYPES)}")
+                return
+
+            # Resolve the path first, an unknown path is a 404 whatever the client sends
+            version, body = tables.body(path, format)
+            if body is None:
+                self._send_error(404, f"Unknown path {path}")
+                return
+            etag = make_etag(version, path, format)
+            # An unchanged version of the same path needs no body at all
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES[format])
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_error(self, status: int, message: str) -> None:
+            body = json.dumps({'error': message}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', CONTENT_TYPES['json'])
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            logging.debug(format % args)
+
+    return AnalysisRequestHandler
+
+
+def create_server(host: str = '127.0.0.1', port: int = 8502,
+                  snapshot: Optional[ArrowSnapshot] = None) -> ThreadingHTTPServer:
+    tables = AnalysisTables(snapshot or ArrowSnapshot())
+    # Precompute before the first request comes in
+    tables.current()
+    return ThreadingHTTPServer((host, port), make_handler(tables))
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port)
+    logging.info(f"Serving the analysis tables on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -1,96 +1,225 @@
 """streamlit app for the sports data visualisation"""
 import streamlit as st
 import pandas as pd
+import matplotlib.pyplot as plt
+import time
+import logging
 st.set_page_config(layout="wide")
 # st.set_option('deprecation.showPyplotGlobalUse', False)
 
 #Use main.py functions in app.py
-from main import DataLoader, ExerciseAnalysis, RunAnalysis
+from main import DataLoader, ExerciseAnalysis, RunAnalysis, NON_WEIGHT_EXERCISES, ANALYSIS_COLUMNS
+from snapshot import ArrowSnapshot
+from rollups import TrainingRollups
+
+# st.fragment replaced st.experimental_fragment in streamlit 1.37
+fragment = getattr(st, 'fragment', None) or st.experimental_fragment
+
+
+# The volume rollups of the latest snapshot version, kept across versions
+@st.cache_resource
+def latest_rollups() -> TrainingRollups:
+    return TrainingRollups()
+
+
+# The data and the analysis objects are shared by all sessions, keyed by the snapshot version
+@st.cache_resource(max_entries=2)
+def load_analysis(version: str):
+    # Only the columns of the analysis are converted from the mapped snapshot
+    cleaned_data = ArrowSnapshot().read_data(version, ANALYSIS_COLUMNS)
+    loader = DataLoader('Sports')
+    validation_report = loader.validate_data(cleaned_data)
+    # Rows such as a weight without matching reps are reported and left out of the analysis
+    cleaned_data = loader.quarantine(cleaned_data, validation_report)
+    # Only the sessions appended since the previous version are aggregated, this version gets its own copy
+    rollups = latest_rollups()
+    rollups.update(cleaned_data)
+    rollups = rollups.copy()
+    return cleaned_data, validation_report, RunAnalysis(cleaned_data, rollups=rollups), \
+        ExerciseAnalysis(cleaned_data, rollups=rollups)
+
+
+@st.cache_data(max_entries=2)
+def unique_running_table(version: str, _running_data: RunAnalysis) -> pd.DataFrame:
+    return _running_data.unique_running_data()
+
+
+@st.cache_data(max_entries=2)
+def group_exercise_table(version: str, _exercise_analysis: ExerciseAnalysis) -> pd.DataFrame:
+    return _exercise_analysis.group_exercise_data()
+
+
+@st.cache_data(max_entries=2)
+def unique_exercise_table(version: str, _exercise_analysis: ExerciseAnalysis) -> pd.DataFrame:
+    return _exercise_analysis.unique_exercise_data()
+
+
+@st.cache_data(max_entries=2)
+def weight_progression_table(version: str, _exercise_analysis: ExerciseAnalysis) -> pd.DataFrame:
+    return _exercise_analysis.weight_progression()
+
+
+@st.cache_data(max_entries=2)
+def pace_progression_table(version: str, _running_data: RunAnalysis) -> pd.DataFrame:
+    return _running_data.pace_progression()
+
+
+# The chart specs hold the serialized data columns, they are built once per data version
+@st.cache_data(max_entries=4)
+def pace_trend_chart(version: str, _running_data: RunAnalysis, trend: bool, selected: float) -> dict:
+    # All distances in one spec, the distance is picked in the chart
+    return _running_data.pace_trend_chart(None, trend, selected)
+
+
+@st.cache_data(max_entries=64)
+def weight_trend_chart(version: str, _exercise_analysis: ExerciseAnalysis, exercise: str, trend: bool) -> dict:
+    return _exercise_analysis.weight_trend_chart(exercise, trend)
+
+
+def show_chart(spec: dict, started: float, panel: str) -> None:
+    st.vega_lite_chart(spec=spec, use_container_width=True)
+    logging.info(f"{panel} rerun took {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def show_figure(fig: plt.Figure, started: float, panel: str) -> None:
+    st.pyplot(fig, use_container_width=True)
+    # Release the figure, pyplot keeps a reference to every figure it creates
+    plt.close(fig)
+    logging.info(f"{panel} rerun took {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+# Every panel is a fragment, a widget change only reruns the panel it belongs to
+@fragment
+def running_panel(version: str, running_data: RunAnalysis, cleaned_data: pd.DataFrame,
+                  unique_running_data: pd.DataFrame, interactive: bool) -> None:
+    started = time.perf_counter()
+    selectbox_options = cleaned_data['distance'].unique()
+    selectbox_options = selectbox_options[~pd.isnull(selectbox_options)]
+    # The widget keys are also used by the load test in benchmark.py
+    trend = st.checkbox('Show trend and forecast', key='pace_trend')
+    if interactive:
+        # Picking the distance in the chart, zooming and toggling the distances in the legend happen in the browser
+        show_chart(pace_trend_chart(version, running_data, trend, float(selectbox_options[0])), started,
+                   'Running panel')
+        return
+    selectbox_options = ['Select all'] + selectbox_options.tolist()
+    distances= st.selectbox('Select the length of the run', selectbox_options, index=1, key='distance',
+                            format_func=lambda d: d if isinstance(d, str) else f'{d:g} km')
+    if distances == 'Select all':
+        #plot the time trend for the exercise 'Run' for the distance selected by the user
+        distances = unique_running_data['Distance (km)'].tolist()
+        fig1 , ax1  = running_data.plot_pace_trend(distances, trend)
+        ax1.set_title(f'Pace trend for the exercise Run for distances')
+    else:
+        #plot the time trend for the exercise 'Run' for the distance selected by the user
+        fig1 , ax1  = running_data.plot_pace_trend(distances, trend)
+    show_figure(fig1, started, 'Running panel')
+
+
+@fragment
+def unique_exercise_panel(version: str, exercise_analysis: ExerciseAnalysis) -> None:
+    started = time.perf_counter()
+    if  st.checkbox('Show data for unique exercise', key='unique_exercises'):
+        st.write(unique_exercise_table(version, exercise_analysis))
+    if st.checkbox('Show weight progression and forecast per exercise', key='weight_progression'):
+        st.write(weight_progression_table(version, exercise_analysis))
+    logging.info(f"Unique exercise panel rerun took {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+@fragment
+def exercise_panel(version: str, exercise_analysis: ExerciseAnalysis, cleaned_data: pd.DataFrame,
+                   interactive: bool) -> None:
+    started = time.perf_counter()
+    #Create a widget to display the weight trend for the exercise which the user inputs
+    #get the unique exercises in the data except the exercise 'Run' and 'Walk' and 'Mountain walk'
+    list_exercises = cleaned_data['exercise'].unique()
+    list_exercises = [exercise for exercise in list_exercises
+                       if exercise not in NON_WEIGHT_EXERCISES]
+    list_exercises = ['Select exercise'] + list_exercises
+
+    #create box
+    exercise = st.selectbox('', list_exercises, key='exercise')
+
+    #if the user selects an exercise
+    if exercise != 'Select exercise':
+        _weight_trend_data = exercise_analysis.weight_trend_data(exercise)
+        st.write('Weight trend data for the exercise', exercise)
+        #only display the data if the user clicks the button and hide the data if the user clicks the button again
+        if st.checkbox('Show data for weight trend', key='weight_trend_data'):
+            st.write(_weight_trend_data)
+
+        #plot the weight trend for the exercise
+        trend = st.checkbox('Show trend and forecast', key='weight_trend')
+        if interactive:
+            show_chart(weight_trend_chart(version, exercise_analysis, exercise, trend), started, 'Exercise panel')
+        else:
+            fig , ax = exercise_analysis.plot_weight_trend(exercise, trend)
+            show_figure(fig, started, 'Exercise panel')
+
+
+@fragment
+def volume_panel(exercise_analysis: ExerciseAnalysis) -> None:
+    started = time.perf_counter()
+    col3, col4 = st.columns(2)
+    with col3:
+        period = st.selectbox('Period', ['week', 'day', 'month'], key='period')
+    with col4:
+        breakdown = st.selectbox('Breakdown', ['group', 'exercise'], key='breakdown')
+    fig2, ax2 = exercise_analysis.plot_volume_heatmap(period, breakdown)
+    show_figure(fig2, started, 'Volume panel')
+
 
 if  __name__ == '__main__':
-    # Load and clean the data
+    # Load the cleaned data from the shared snapshot, all sessions share one DataFrame per version
+    snapshot = ArrowSnapshot()
     loader = DataLoader('Sports')
-    data = loader.read_data()
-    cleaned_data = loader.clean_data(data)
+    version = snapshot.current_version() or snapshot.publish(loader.clean_data(loader.read_data()))
+    cleaned_data, validation_report, running_data, exercise_analysis = load_analysis(version)
 
-    # Perform run analysis
-    running_data = RunAnalysis(cleaned_data)
-    unique_running_data = running_data.unique_running_data()
+    # Interactive charts are drawn in the browser, matplotlib figures are rendered on the server
+    interactive = st.sidebar.radio('Charts', ['Interactive', 'Matplotlib'], key='charts') == 'Interactive'
 
-    # Perform exercise analysis
-    exercise_analysis = ExerciseAnalysis(cleaned_data)
+    # Report rows with bad data before running the analysis
+    if not validation_report.empty:
+        with st.expander(f'{len(validation_report)} problems found in the data'):
+            st.write(validation_report)
 
-    
+    # Perform run analysis
+    unique_running_data = unique_running_table(version, running_data)
 
     col1 ,col2 = st.columns(2)
     with col1:
         st.title('Running Performance')
         st.markdown('In this section, we will analyze the running performance based on the data obtained during training.\
                     The training mostly consist of running exercises. We will analyze the pace trend for each distance.')
-        
+
         #table with the unique distances in the data
         st.write(unique_running_data)
 
-        # multiselect widget to select the length of the run 
-        st.header('Select the length of the run for which you want to see the time trend')
-        selectbox_options = cleaned_data['distance'].unique()
-        selectbox_options = selectbox_options[~pd.isnull(selectbox_options)]
-        selectbox_options = ['Select all'] + selectbox_options.tolist()
-        distances= st.selectbox('Select the length of the run', selectbox_options, index=1) 
-        if distances == 'Select all':
-            #plot the time trend for the exercise 'Run' for the distance selected by the user
-            distances = unique_running_data['Distance (km)'].astype(str).tolist()
-            fig1 , ax1  = running_data.plot_pace_trend(distances)
-            ax1.set_title(f'Pace trend for the exercise Run for distances') 
-            st.pyplot(fig1, use_container_width=True)
-        else:
-            #plot the time trend for the exercise 'Run' for the distance selected by the user
-            fig1 , ax1  = running_data.plot_pace_trend(distances)
-            st.pyplot(fig1, use_container_width=True)
-    
-        
-
+        # Pace trend per distance with a forecast four weeks ahead, a negative slope means getting faster
+        st.subheader('Pace trend and forecast')
+        st.write(pace_progression_table(version, running_data))
 
+        # multiselect widget to select the length of the run
+        st.header('Select the length of the run for which you want to see the time trend')
+        running_panel(version, running_data, cleaned_data, unique_running_data, interactive)
 
     with col2:
         st.title('Athletic Performance')
         st.write('In this section, we will analyze the athletic performance based on the data obtained during training.\
                  The training mostly consist of weighted exercises in the gym. Where for each exercise,\
-                 the weight lifted is recorded. We will analyze the weight trend for each exercise.') 
+                 the weight lifted is recorded. We will analyze the weight trend for each exercise.')
 
         st.header('Group exercise performance')
         #table with the groups in the data
-        group_exercise_data = exercise_analysis.group_exercise_data()
+        group_exercise_data = group_exercise_table(version, exercise_analysis)
         st.write(group_exercise_data)
 
         #table with the groups and the exercises in the data
         st.header('Exercise analysis')
-        if  st.checkbox('Show data for unique exercise'): 
-            unique_exercises = exercise_analysis.unique_exercise_data()
-            st.write(unique_exercises)
-
-        #Create a widget to display the weight trend for the exercise which the user inputs
-        #get the unique exercises in the data except the exercise 'Run' and 'Walk' and 'Mountain walk'
-        list_exercises = cleaned_data['exercise'].unique()
-        list_exercises = [exercise for exercise in list_exercises 
-                           if exercise not in ['Run', 'Walk', 'Mountain walk','Stretch']]
-        list_exercises = ['Select exercise'] + list_exercises
-
- 
-        #create box 
-        exercise = st.selectbox('', list_exercises)
-
-        #if the user selects an exercise
-        if exercise != 'Select exercise':
-            _weight_trend_data = exercise_analysis.weight_trend_data(exercise)
-            st.write('Weight trend data for the exercise', exercise)
-            #only display the data if the user clicks the button and hide the data if the user clicks the button again
-            if st.checkbox('Show data for weight trend'):
-                st.write(_weight_trend_data)
-
-            #plot the weight trend for the exercise
-            fig , ax = exercise_analysis.plot_weight_trend(exercise)
-            st.pyplot(fig, use_container_width=True)
-
-
+        unique_exercise_panel(version, exercise_analysis)
+        exercise_panel(version, exercise_analysis, cleaned_data, interactive)
 
+    st.title('Training Volume')
+    st.write('The volume (weight times reps) lifted per period, taken from the materialized rollups.')
+    volume_panel(exercise_analysis)
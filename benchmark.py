@@ -0,0 +1,411 @@
+""" Benchmarks for the sports data analysis.
+
+    The benchmarks run on synthetic data in the cleaned format of DataLoader.clean_data,
+    so the size of the training history can be scaled far beyond data.xlsx.
+    Run 'python benchmark.py store --sets 1000000' to compare the SQL store with the pandas path
+    and 'python benchmark.py charts' to compare the chart backends.
+    'python benchmark.py api' load tests the JSON API with concurrent clients.
+    'python benchmark.py trends --athletes 200' times the batched trend fits against a loop per exercise.
+    'python benchmark.py dashboard --sessions 1 4 16' load tests app.py with simulated sessions and
+    compares the full reruns with the panel times of the fragment reruns a streamlit server does.
+    """
+#%%
+import os
+import re
+import time
+import logging
+import argparse
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from main import ExerciseAnalysis, RunAnalysis
+
+EXERCISES = ['Bench press', 'Incline bench', 'Chest fly', 'Shoulder press', 'Skull crusher', 'Deadlift',
+             'Lat pull down', 'Seated rows', 'Bicep curl', 'Pull-ups', 'Squat', 'Leg press',
+             'Leg curl', 'Leg extension', 'Calf raise', 'Plank', 'Crunches', 'Low back raise']
+GROUPS = ['Back', 'Chest', 'Legs', 'Shoulders', 'Core', 'Back + Chest']
+DISTANCES = [1.0, 3.0, 5.0, 6.0, 10.0]
+
+
+def synthetic_data(n_sets: int, sets_per_row: int = 3, run_fraction: float = 0.02, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_rows = max(n_sets // sets_per_row, 1)
+    # Roughly eight exercises per training day
+    dates = pd.Timestamp('2015-01-01') + pd.to_timedelta(np.arange(n_rows) // 8, unit='D')
+    is_run = rng.random(n_rows) < run_fraction
+
+    weights = rng.integers(20, 120, size=(n_rows, sets_per_row)).astype(float)
+    reps = rng.integers(4, 13, size=(n_rows, sets_per_row)).astype(float)
+    seconds = rng.integers(4 * 60, 60 * 60, size=n_rows)
+
+    data = pd.DataFrame({
+        'group': np.array(GROUPS, dtype=object)[(np.arange(n_rows) // 8) % len(GROUPS)],
+        'training_time': pd.Timedelta(hours=1),
+        'date': dates,
+        'exercise': np.where(is_run, 'Run', np.array(EXERCISES, dtype=object)[rng.integers(0, len(EXERCISES), n_rows)]),
+        'variation': None,
+        'weight': list(weights),
+        'reps': list(reps),
+        'total_time': pd.to_timedelta(np.where(is_run, seconds, np.nan), unit='s'),
+        'distance': np.where(is_run, np.array(DISTANCES)[rng.integers(0, len(DISTANCES), n_rows)], np.nan),
+        'speed': np.nan,
+        'slope': None,
+        'notes': None,
+    })
+    data['weight'] = data['weight'].apply(list)
+    data['reps'] = data['reps'].apply(list)
+    return data
+
+
+def timeit(function: Callable, repeat: int = 3, clock: Callable = time.perf_counter) -> float:
+    # Best time in milliseconds, pass time.process_time as clock to measure CPU time
+    timings = []
+    for _ in range(repeat):
+        start = clock()
+        function()
+        timings.append((clock() - start) * 1000)
+    return min(timings)
+
+
+def print_results(results: List[Dict]) -> None:
+    print(pd.DataFrame(results).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+
+def pandas_volume_per_group_per_month(data: pd.DataFrame) -> pd.DataFrame:
+    # The ad hoc pandas version of TrainingStore.volume_per_group_per_month
+    sets = data[['date', 'group', 'weight', 'reps']].explode(['weight', 'reps'])
+    sets['volume'] = sets['weight'].astype(float) * sets['reps'].astype(float)
+    sets['month'] = sets['date'].dt.strftime('%Y-%m')
+    sets['group'] = sets['group'].fillna('No group').str.split('+')
+    sets = sets.explode('group')
+    sets['group'] = sets['group'].str.strip()
+    return sets.groupby(['month', 'group']).agg(volume=('volume', 'sum'), sets=('volume', 'size')).reset_index()
+
+
+def benchmark_store(n_sets: int) -> None:
+    from store import TrainingStore
+
+    data = synthetic_data(n_sets)
+    logging.info(f"Synthetic data: {len(data)} rows, {n_sets} sets")
+    with tempfile.TemporaryDirectory() as directory:
+        store = TrainingStore(os.path.join(directory, 'training.sqlite'))
+        start = time.perf_counter()
+        store.populate(data)
+        logging.info(f"Populated the store in {time.perf_counter() - start:.1f} s")
+
+        # Without memoization, every repeat runs the query
+        exercise_pandas, exercise_store = ExerciseAnalysis(data, cache_size=0), ExerciseAnalysis(data, store, cache_size=0)
+        run_pandas, run_store = RunAnalysis(data, cache_size=0), RunAnalysis(data, store, cache_size=0)
+        queries = {
+            'weight_trend_data': (lambda: exercise_pandas.weight_trend_data('Deadlift'),
+                                  lambda: store.exercise_sets('Deadlift')),
+            'total_weight_lifted_last_5': (exercise_pandas.total_weight_lifted_last_5,
+                                           exercise_store.total_weight_lifted_last_5),
+            'unique_running_data': (run_pandas.unique_running_data, run_store.unique_running_data),
+            'volume_per_group_per_month': (lambda: pandas_volume_per_group_per_month(data),
+                                           store.volume_per_group_per_month),
+        }
+        results = []
+        for name, (pandas_query, store_query) in queries.items():
+            # Both sides get the same number of repeats, the best one counts
+            results.append({'query': name, 'pandas (ms)': timeit(pandas_query),
+                            'sqlite (ms)': timeit(store_query)})
+        store.close()
+    print_results(results)
+
+
+def benchmark_charts(n_sets: int) -> None:
+    import io
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import charts
+
+    def rasterize(fig: plt.Figure) -> None:
+        # What st.pyplot does on every rerun
+        fig.savefig(io.BytesIO(), format='png', dpi=200, bbox_inches='tight')
+        plt.close(fig)
+
+    data = synthetic_data(n_sets)
+    exercise_analysis, run_analysis = ExerciseAnalysis(data), RunAnalysis(data)
+    # Both backends start from the same trend data
+    exercise_data = exercise_analysis.weight_trend_data('Deadlift')
+    run_data = run_analysis.running_data()
+    exercise_analysis.weight_trend_data = lambda exercise: exercise_data
+    run_analysis.running_data = lambda: run_data
+
+    interactions = {
+        'weight trend': (lambda: rasterize(exercise_analysis.plot_weight_trend('Deadlift')[0]),
+                         lambda: charts.to_json(exercise_analysis.weight_trend_chart('Deadlift'))),
+        'pace trend, one distance': (lambda: rasterize(run_analysis.plot_pace_trend(5.0)[0]),
+                                     lambda: charts.to_json(run_analysis.pace_trend_chart(5.0))),
+        'pace trend, all distances': (lambda: rasterize(run_analysis.plot_pace_trend(DISTANCES)[0]),
+                                      lambda: charts.to_json(run_analysis.pace_trend_chart())),
+    }
+    results = []
+    for name, (matplotlib_chart, vega_chart) in interactions.items():
+        spec_size = len(vega_chart())
+        results.append({'interaction': name,
+                        'matplotlib cpu (ms)': timeit(matplotlib_chart, clock=time.process_time),
+                        'vega-lite cpu (ms)': timeit(vega_chart, clock=time.process_time),
+                        'spec (kB)': spec_size / 1024})
+    print_results(results)
+
+def benchmark_trends(n_sets: int, athletes: int = 200) -> None:
+    import trends
+
+    data = synthetic_data(n_sets)
+    # Every athlete has their own series of every exercise
+    athlete = np.random.default_rng(1).integers(0, athletes, size=len(data))
+    is_run = data['exercise'] == 'Run'
+    data['exercise'] = data['exercise'].where(is_run, data['exercise'] + ' #' + pd.Series(athlete).astype(str))
+    exercise_analysis = ExerciseAnalysis(data, cache_size=0)
+    run_analysis = RunAnalysis(data, cache_size=0)
+    run_data = run_analysis.running_data()
+    logging.info(f"Synthetic data: {len(data)} rows, {data['exercise'].nunique()} exercises")
+
+    def loop_weight_slopes() -> None:
+        # The per-exercise alternative: filter the sets of one exercise and fit its line
+        for exercise in data.loc[~is_run, 'exercise'].unique():
+            exercise_data = exercise_analysis.weight_trend_data(exercise)
+            days = (exercise_data['date'] - data['date'].min()).dt.days.to_numpy()
+            np.polyfit(days, exercise_data['weight'].to_numpy(), 1)
+
+    def loop_pace_slopes() -> None:
+        for distance in run_data['distance'].dropna().unique():
+            distance_data = run_data.loc[(run_data['distance'] == distance) & run_data['pace'].notnull()]
+            np.polyfit((distance_data['date'] - data['date'].min()).dt.days.to_numpy(), distance_data['pace'].to_numpy(), 1)
+
+    results = [
+        {'fit': 'weight, least squares', 'series': data.loc[~is_run, 'exercise'].nunique(),
+         'batched (ms)': timeit(exercise_analysis.weight_trend_fits),
+         'loop (ms)': timeit(loop_weight_slopes, repeat=1)},
+        {'fit': 'weight, robust', 'series': data.loc[~is_run, 'exercise'].nunique(),
+         'batched (ms)': timeit(lambda: exercise_analysis.weight_trend_fits(robust=True)), 'loop (ms)': np.nan},
+        {'fit': 'pace, least squares', 'series': run_data['distance'].nunique(),
+         'batched (ms)': timeit(lambda: trends.fit_trends(run_data['distance'], run_data['date'], run_data['pace'])),
+         'loop (ms)': timeit(loop_pace_slopes)},
+    ]
+    print_results(results)
+
+def benchmark_api(n_sets: int, duration: float = 5.0) -> None:
+    import threading
+    import http.client
+    from api import create_server
+    from snapshot import ArrowSnapshot
+
+    paths = ['/running', '/groups', '/exercises', '/exercises/Deadlift/trend', '/exercises/Squat/trend?format=arrow']
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = ArrowSnapshot(directory)
+        snapshot.publish(synthetic_data(n_sets))
+        server = create_server(port=0, snapshot=snapshot)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+        def client(conditional: bool, counts: List[int]) -> None:
+            connection = http.client.HTTPConnection(host, port)
+            etags: Dict[str, str] = {}
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                path = paths[counts[0] % len(paths)]
+                headers = {'If-None-Match': etags[path]} if conditional and path in etags else {}
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                etags[path] = response.getheader('ETag')
+                counts[0] += 1
+            connection.close()
+
+        results = []
+        for clients in [1, 4, 16, 64]:
+            for conditional in [False, True]:
+                counts = [[0] for _ in range(clients)]
+                threads = [threading.Thread(target=client, args=(conditional, count)) for count in counts]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                results.append({'clients': clients, 'If-None-Match': conditional,
+                                'requests/s': sum(count[0] for count in counts) / duration})
+        server.shutdown()
+        server.server_close()
+    print_results(results)
+
+def rss_mb() -> float:
+    # Current resident memory from /proc, the peak so far where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def dashboard_interaction(at, rng: np.random.Generator) -> str:
+    # One widget change of a user, picked from what the current page shows
+    actions = ['exercise', 'pace_trend', 'unique_exercises', 'weight_progression', 'period', 'breakdown', 'charts']
+    # The interactive pace chart picks the distance in the browser, only the matplotlib page has the selectbox
+    if at.sidebar.radio(key='charts').value == 'Matplotlib':
+        actions += ['distance']
+    if at.selectbox(key='exercise').value != 'Select exercise':
+        actions += ['weight_trend', 'weight_trend_data']
+    action = actions[rng.integers(len(actions))]
+    if action == 'charts':
+        # Most users stay on the interactive charts
+        widget = at.sidebar.radio(key='charts')
+        widget.set_value('Matplotlib' if widget.value == 'Interactive' and rng.random() < 0.3 else 'Interactive')
+    elif action in ('distance', 'exercise', 'period', 'breakdown'):
+        widget = at.selectbox(key=action)
+        # Skip 'Select exercise', a user picks an actual exercise
+        widget.select_index(int(rng.integers(1 if action == 'exercise' else 0, len(widget.options))))
+    else:
+        widget = at.checkbox(key=action)
+        widget.set_value(not widget.value)
+    return action
+
+
+# The panel of app.py a widget change reruns on a streamlit server, the other widgets rerun the whole script
+PANEL_OF_WIDGET = {'distance': 'Running panel', 'pace_trend': 'Running panel', 'exercise': 'Exercise panel',
+                   'weight_trend': 'Exercise panel', 'weight_trend_data': 'Exercise panel',
+                   'unique_exercises': 'Unique exercise panel', 'weight_progression': 'Unique exercise panel',
+                   'period': 'Volume panel', 'breakdown': 'Volume panel'}
+
+
+class PanelTimings(logging.Handler):
+    # Collects the 'X panel rerun took N ms' lines the panels of app.py log
+    pattern = re.compile(r'(.+ panel) rerun took (\d+) ms')
+
+    def __init__(self) -> None:
+        super().__init__(logging.INFO)
+        self.timings: List[Dict] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        match = self.pattern.fullmatch(record.getMessage())
+        if match:
+            self.timings.append({'panel': match.group(1), 'ms': float(match.group(2))})
+
+
+def benchmark_dashboard(session_counts: List[int], interactions: int = 20, think_time: float = 0.0,
+                        clear_caches: bool = False, output: Optional[str] = None) -> None:
+    import threading
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+
+    # Every session is a headless run of app.py in this process, as the sessions of one streamlit server.
+    # AppTest reruns the whole script on a widget change, also the fragments a server would leave alone,
+    # so the latencies are those of full reruns. The time a server spends on a fragment rerun is the
+    # time of its panel, which the panels log and PanelTimings collects.
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    root = logging.getLogger()
+    for handler in root.handlers:
+        handler.setLevel(logging.WARNING)
+    panel_timings = PanelTimings()
+    root.addHandler(panel_timings)
+    root.setLevel(logging.INFO)
+    # The deprecation and label warnings of streamlit would be repeated on every rerun
+    import streamlit.logger
+    streamlit.logger.set_log_level('error')
+
+    def session(seed: int, latencies: List[Dict], errors: List[str]) -> None:
+        rng = np.random.default_rng(seed)
+        start = time.perf_counter()
+        at = AppTest.from_file(app_path, default_timeout=600).run()
+        latencies.append({'interaction': 'first load', 'ms': (time.perf_counter() - start) * 1000})
+        for _ in range(interactions):
+            time.sleep(think_time * rng.exponential() if think_time else 0)
+            start = time.perf_counter()
+            action = dashboard_interaction(at, rng)
+            at.run()
+            latencies.append({'interaction': action, 'ms': (time.perf_counter() - start) * 1000})
+            errors += [exception.message for exception in at.exception]
+
+    results, all_latencies, all_panels = [], [], []
+    for sessions in session_counts:
+        if clear_caches:
+            # Measure the cold start, without the data and tables of the previous round
+            st.cache_data.clear()
+            st.cache_resource.clear()
+        latencies: List[Dict] = []
+        errors: List[str] = []
+        panel_timings.timings = []
+        threads = [threading.Thread(target=session, args=(seed, latencies, errors)) for seed in range(sessions)]
+
+        # Sample the memory while the sessions run
+        peak_rss, done = [rss_mb()], threading.Event()
+        def sample_rss() -> None:
+            while not done.wait(0.1):
+                peak_rss[0] = max(peak_rss[0], rss_mb())
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        done.set()
+        sampler.join()
+
+        timings = pd.DataFrame(latencies)
+        reruns = timings.loc[timings['interaction'] != 'first load', 'ms']
+        results.append({'sessions': sessions, 'reruns': len(reruns),
+                        'first load p50 (ms)': timings.loc[timings['interaction'] == 'first load', 'ms'].median(),
+                        'p50 (ms)': reruns.quantile(0.5), 'p90 (ms)': reruns.quantile(0.9),
+                        'p99 (ms)': reruns.quantile(0.99), 'max (ms)': reruns.max(),
+                        'reruns/s': len(reruns) / wall, 'cpu (%)': cpu / wall * 100,
+                        'peak rss (MB)': peak_rss[0], 'errors': len(errors)})
+        all_latencies.append(timings.assign(sessions=sessions))
+        all_panels.append(pd.DataFrame(panel_timings.timings, columns=['panel', 'ms']).assign(sessions=sessions))
+        for error in sorted(set(errors)):
+            logging.warning(f"{sessions} sessions: {error}")
+
+    print_results(results)
+    # Latency per widget over all rounds, to see which panel limits the number of sessions
+    latencies = pd.concat(all_latencies, ignore_index=True)
+    per_interaction = latencies.groupby(['interaction', 'sessions'])['ms'].quantile([0.5, 0.9]).unstack()
+    per_interaction.columns = ['p50 (ms)', 'p90 (ms)']
+    print()
+    print(per_interaction.unstack('sessions').to_string(float_format=lambda x: f'{x:.0f}'))
+
+    # The full rerun of a widget change next to the time of the one panel a server reruns for it
+    full_p50 = latencies.groupby(['interaction', 'sessions'])['ms'].median()
+    panel_p50 = pd.concat(all_panels, ignore_index=True).groupby(['panel', 'sessions'])['ms'].median()
+    fragments = pd.DataFrame([{'widget': widget, 'sessions': sessions, 'panel': panel,
+                               'full rerun p50 (ms)': full_p50.get((widget, sessions), np.nan),
+                               'fragment p50 (ms)': panel_p50.get((panel, sessions), np.nan)}
+                              for widget, panel in PANEL_OF_WIDGET.items() for sessions in session_counts])
+    print()
+    print(fragments.to_string(index=False, float_format=lambda x: f'{x:.0f}'))
+    if output:
+        pd.DataFrame(results).to_csv(output, index=False)
+        logging.warning(f"Wrote the report to {output}")
+
+#%%
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=['store', 'charts', 'api', 'trends', 'dashboard'])
+    parser.add_argument('--sets', type=int, default=None)
+    parser.add_argument('--athletes', type=int, default=200)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4, 16],
+                        help='numbers of concurrent dashboard sessions, one round each')
+    parser.add_argument('--interactions', type=int, default=20, help='widget changes per dashboard session')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds between two widget changes')
+    parser.add_argument('--clear-caches', action='store_true', help='clear the streamlit caches before every round')
+    parser.add_argument('--output', default=None, help='CSV file for the dashboard report')
+    args = parser.parse_args()
+
+    if args.benchmark == 'store':
+        benchmark_store(args.sets or 1_000_000)
+    elif args.benchmark == 'charts':
+        benchmark_charts(args.sets or 30_000)
+    elif args.benchmark == 'api':
+        benchmark_api(args.sets or 30_000)
+    elif args.benchmark == 'trends':
+        benchmark_trends(args.sets or 1_000_000, args.athletes)
+    elif args.benchmark == 'dashboard':
+        benchmark_dashboard(args.sessions, args.interactions, args.think_time, args.clear_caches, args.output)
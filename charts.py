@@ -0,0 +1,135 @@
+""" Vega-Lite chart specs for the trend plots.
+
+    The specs are plain JSON-serializable dicts rendered in the browser, so zooming, hovering,
+    picking a distance in the dropdown of the pace chart and toggling the distances in the legend
+    happen on the client without a rerun on the server.
+    The data columns are serialized once into a named dataset which all layers of a chart reuse.
+    A trend line from trends.py adds a dashed line and a prediction band layer with its own dataset.
+    """
+#%%
+import json
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+VEGA_LITE_SCHEMA = 'https://vega.github.io/schema/vega-lite/v5.json'
+
+
+def chart_records(data: pd.DataFrame, columns: List[str]) -> List[Dict]:
+    # Dates as ISO strings and numbers as plain floats, the records go straight into the spec
+    records = data[columns].copy()
+    for column in columns:
+        if pd.api.types.is_datetime64_any_dtype(records[column]):
+            records[column] = records[column].dt.strftime('%Y-%m-%d')
+        elif pd.api.types.is_numeric_dtype(records[column]):
+            records[column] = records[column].astype(float).round(3)
+    records = records.astype(object).where(records.notnull(), None)
+    return records.to_dict(orient='records')
+
+
+def trend_layers(dataset: str, title: str, toggle: Optional[str] = None) -> List[Dict]:
+    # The prediction band and the dashed fitted line, both read the trend dataset. The opacity is an
+    # encoding of its own: a layer inherits the opacity encoding of the chart, which would override
+    # the opacity of the mark. With a toggle the layers fade with the legend selection of that name
+    tooltip = [{'field': 'date', 'type': 'temporal', 'title': 'Date'},
+               {'field': 'fit', 'type': 'quantitative', 'title': f'Trend {title}', 'format': '.2f'},
+               {'field': 'lower', 'type': 'quantitative', 'title': 'Lower 95%', 'format': '.2f'},
+               {'field': 'upper', 'type': 'quantitative', 'title': 'Upper 95%', 'format': '.2f'}]
+
+    def opacity(value: float) -> Dict:
+        return {'value': value} if toggle is None else {'condition': {'param': toggle, 'value': value},
+                                                        'value': value / 10}
+    return [
+        {'data': {'name': dataset}, 'mark': {'type': 'area'},
+         'encoding': {'x': {'field': 'date', 'type': 'temporal'},
+                      'y': {'field': 'lower', 'type': 'quantitative'}, 'y2': {'field': 'upper'},
+                      'opacity': opacity(0.15), 'tooltip': tooltip}},
+        {'data': {'name': dataset}, 'mark': {'type': 'line', 'strokeDash': [6, 4]},
+         'encoding': {'x': {'field': 'date', 'type': 'temporal'},
+                      'y': {'field': 'fit', 'type': 'quantitative'},
+                      'opacity': opacity(1.0), 'tooltip': tooltip}},
+    ]
+
+
+def weight_trend_spec(exercise_data: pd.DataFrame, exercise: str, trend_line: Optional[pd.DataFrame] = None) -> Dict:
+    spec = {
+        '$schema': VEGA_LITE_SCHEMA,
+        'title': f'Weight trend of the exercise {exercise}',
+        'datasets': {'sets': chart_records(exercise_data, ['date', 'weight', 'reps'])},
+        'data': {'name': 'sets'},
+        'params': [{'name': 'zoom', 'select': 'interval', 'bind': 'scales'}],
+        'mark': {'type': 'circle', 'opacity': 0.5},
+        'encoding': {
+            'x': {'field': 'date', 'type': 'temporal', 'title': 'Date',
+                  'axis': {'format': '%b-%d', 'labelAngle': -45}},
+            'y': {'field': 'weight', 'type': 'quantitative', 'title': 'Weight (kg)'},
+            'size': {'field': 'reps', 'type': 'quantitative', 'title': 'Reps'},
+            'color': {'field': 'reps', 'type': 'quantitative', 'title': 'Reps', 'scale': {'scheme': 'rainbow'}},
+            'tooltip': [{'field': 'date', 'type': 'temporal', 'title': 'Date'},
+                        {'field': 'weight', 'type': 'quantitative', 'title': 'Weight (kg)'},
+                        {'field': 'reps', 'type': 'quantitative', 'title': 'Reps'}],
+        },
+    }
+    if trend_line is None:
+        return spec
+    # The sets become the first layer, the trend layers keep their own grey color
+    layer = {key: spec.pop(key) for key in ['data', 'params', 'mark', 'encoding']}
+    spec['datasets']['trend'] = chart_records(trend_line, ['date', 'fit', 'lower', 'upper'])
+    spec['layer'] = [layer] + [{**trend_layer, 'mark': {**trend_layer['mark'], 'color': 'grey'}}
+                               for trend_layer in trend_layers('trend', '(kg)')]
+    return spec
+
+
+def pace_trend_spec(run_data: pd.DataFrame, distances: Optional[List[float]] = None,
+                    trend_lines: Optional[pd.DataFrame] = None, selected: Optional[float] = None) -> Dict:
+    # Without distances the chart holds all of them and a dropdown in the chart picks the one shown,
+    # starting at selected, so changing the distance needs no new spec from the server
+    spec = {
+        '$schema': VEGA_LITE_SCHEMA,
+        'title': 'Pace trend for different distances',
+        # The line and the point layer read the same dataset
+        'datasets': {'runs': chart_records(run_data.loc[run_data['distance'].notnull()],
+                                           ['date', 'distance', 'pace'])},
+        'data': {'name': 'runs'},
+        'transform': [],
+        'encoding': {
+            'x': {'field': 'date', 'type': 'temporal', 'title': 'Date',
+                  'axis': {'format': '%b-%d', 'labelAngle': -45}},
+            'y': {'field': 'pace', 'type': 'quantitative', 'title': 'Pace (min per km)'},
+            'color': {'field': 'distance', 'type': 'nominal', 'title': 'Distance (km)'},
+            # Clicking a distance in the legend highlights it
+            'opacity': {'condition': {'param': 'distance_toggle', 'value': 1}, 'value': 0.1},
+            'tooltip': [{'field': 'date', 'type': 'temporal', 'title': 'Date'},
+                        {'field': 'distance', 'type': 'nominal', 'title': 'Distance (km)'},
+                        {'field': 'pace', 'type': 'quantitative', 'title': 'Pace (min per km)', 'format': '.2f'}],
+        },
+        'layer': [
+            {'mark': {'type': 'line'},
+             'params': [{'name': 'distance_toggle', 'select': {'type': 'point', 'fields': ['distance']},
+                         'bind': 'legend'},
+                        {'name': 'zoom', 'select': 'interval', 'bind': 'scales'}]},
+            {'mark': {'type': 'point', 'filled': True}},
+        ],
+    }
+    if distances is not None:
+        spec['transform'].append({'filter': {'field': 'distance', 'oneOf': list(distances)}})
+    else:
+        # 0 stands for all distances
+        options = sorted(run_data['distance'].dropna().unique().tolist())
+        spec['params'] = [{'name': 'distance_choice', 'value': selected or 0,
+                           'bind': {'input': 'select', 'name': 'Distance ', 'options': [0] + options,
+                                    'labels': ['All'] + [f'{d:g} km' for d in options]}}]
+        spec['transform'].append({'filter': 'distance_choice == 0 || datum.distance == distance_choice'})
+    if trend_lines is not None:
+        # The trend layers take the color of their distance from the top level encoding and fade with the
+        # legend toggle, they read their own dataset and so need their own filter
+        spec['datasets']['trends'] = chart_records(trend_lines, ['distance', 'date', 'fit', 'lower', 'upper'])
+        band, line = [{**trend_layer, 'transform': list(spec['transform'])}
+                      for trend_layer in trend_layers('trends', '(min per km)', 'distance_toggle')]
+        # The band goes below the runs, the fitted line on top of them
+        spec['layer'] = [band] + spec['layer'] + [line]
+    return spec
+
+
+def to_json(spec: Dict) -> str:
+    return json.dumps(spec, separators=(',', ':'))
@@ -17,21 +17,186 @@
     DataLoader is used to load and clean the data, while ExerciseAnalysis is used to analyze the exercise data.
     """
 #%%
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import logging
 import matplotlib.dates as mdates
-from typing import Tuple, List, Union
+from typing import Tuple, List, Union, Optional, Dict, Callable, TYPE_CHECKING
+import datetime
 import os
+import re
+import ast
+import operator
+import threading
+
+import charts
+import trends
+from memo import MemoCache, memoized, data_property
+
+if TYPE_CHECKING:
+    from store import TrainingStore
+    from rollups import TrainingRollups
 
 logging.basicConfig(level=logging.INFO)
 
+# Exercises without weights, these are left out of the exercise analysis
+NON_WEIGHT_EXERCISES = ['Run', 'Walk', 'Mountain walk', 'Stretch']
+
+# Checks whose rows break the analysis, DataLoader.quarantine leaves these rows out of it
+QUARANTINED_CHECKS = ['set_length_mismatch']
+
+# Columns read by ExerciseAnalysis, RunAnalysis and DataLoader.validate_data
+ANALYSIS_COLUMNS = ['group', 'date', 'exercise', 'weight', 'reps', 'total_time', 'distance', 'speed']
+
+# Paces outside this range (min per km) are considered typing errors
+MIN_PACE = 2.5
+MAX_PACE = 20.0
+
+# Weight used for body weight exercises and rows without a weight
+BODY_WEIGHT = 80.0
+
+# Only sums and products of numbers are evaluated in the reps column, e.g. '2*8+5' or '3*(8+2)'
+REPS_OPERATORS = {ast.Add: operator.add, ast.Mult: operator.mul}
+
+# Every converter turns one column of the sheet into its final type in one go and
+# returns the converted column together with the cells that could not be converted
+Converter = Callable[[pd.Series], Tuple[pd.Series, pd.Series]]
+
+
+def _strip(values: pd.Series) -> pd.Series:
+    return values.map(lambda x: x.strip() if isinstance(x, str) else x)
+
+
+def to_text(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    text = values.astype(object).where(values.isnull(), values.astype(str).str.strip())
+    return text, pd.Series(False, index=values.index)
+
+
+def to_number(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    numbers = pd.to_numeric(_strip(values), errors='coerce').astype(float)
+    return numbers, values.notnull() & numbers.isnull()
+
+
+def to_date(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    # Native Excel dates come in as datetimes, dates typed as text are parsed
+    dates = pd.to_datetime(_strip(values), errors='coerce', format='mixed')
+    return dates, values.notnull() & dates.isnull()
+
+
+def _to_timedelta(values: pd.Series, unit: str) -> Tuple[pd.Series, pd.Series]:
+    # 'A:B' is read as A in the unit of the column and B in the next smaller unit, 'H:MM:SS' is always a full time
+    smaller_unit = {'hours': 'minutes', 'minutes': 'seconds'}[unit]
+
+    def convert(x):
+        if isinstance(x, datetime.timedelta):
+            # Excel stores '25:30' as a duration of 25 hours 30 minutes, the same two fields as a time
+            x = pd.Timedelta(x).round('s')
+            if unit == 'hours' or x.seconds % 60:
+                return x
+            return pd.Timedelta(**{unit: x.days * 24 + x.seconds // 3600, smaller_unit: x.seconds // 60 % 60})
+        if isinstance(x, datetime.time):
+            # Excel reads '18:00' as a time of day, its hours and minutes are taken as the two fields,
+            # with seconds it was typed as a full 'H:MM:SS'
+            if unit == 'hours' or x.second:
+                return pd.Timedelta(hours=x.hour, minutes=x.minute, seconds=x.second)
+            return pd.Timedelta(**{unit: x.hour, smaller_unit: x.minute})
+        if isinstance(x, (int, float)):
+            return pd.Timedelta(**{unit: x})
+        match = re.fullmatch(r'(\d+):(\d{1,2})(?::(\d{2}))?', str(x).strip())
+        if match is None:
+            return pd.NaT
+        first, second, third = match.groups()
+        if third is not None:
+            return pd.Timedelta(hours=int(first), minutes=int(second), seconds=int(third))
+        return pd.Timedelta(**{unit: int(first), smaller_unit: int(second)})
+
+    durations = pd.to_timedelta(values.map(convert, na_action='ignore'))
+    return durations, values.notnull() & durations.isnull()
+
+
+def to_duration(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    # 'H:MM' or 'H:MM:SS'
+    return _to_timedelta(values, 'hours')
+
+
+def to_minutes(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    # 'MM:SS', a plain number is a number of minutes
+    return _to_timedelta(values, 'minutes')
+
+
+def _to_list(values: pd.Series, default: str, convert: Callable[[pd.Series], pd.Series]) -> Tuple[pd.Series, pd.Series]:
+    # Split '60-65-60' into one value per set and convert all sets of the column at once
+    text = values.astype(str).str.strip().where(values.notnull(), default)
+    split = text.str.split('-')
+    numbers = convert(split.explode().str.strip()).to_numpy(dtype=float)
+    # Cut the flat array back into one list per row, a groupby over 'level=0' is far slower
+    ends = split.str.len().cumsum().to_numpy()
+    starts = ends - split.str.len().to_numpy()
+    lists = pd.Series([numbers[start:end].tolist() for start, end in zip(starts, ends)], index=values.index, dtype=object)
+    failed = pd.Series(np.add.reduceat(np.isnan(numbers), starts) > 0, index=values.index) if len(numbers) else \
+        pd.Series(False, index=values.index)
+    return lists, failed
+
+
+def to_weights(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    values = values.where(_strip(values) != 'body', BODY_WEIGHT)
+    return _to_list(values, str(BODY_WEIGHT), lambda sets: pd.to_numeric(sets, errors='coerce').astype(float))
+
+
+def _evaluate_reps(node: ast.AST) -> float:
+    # Numbers, + and *, parentheses only group; anything else is not a number of reps
+    if isinstance(node, ast.Expression):
+        return _evaluate_reps(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return float(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in REPS_OPERATORS:
+        return REPS_OPERATORS[type(node.op)](_evaluate_reps(node.left), _evaluate_reps(node.right))
+    raise ValueError(f"Unsupported reps expression {ast.dump(node)}")
+
+
+def to_reps(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    def evaluate(expression: str) -> float:
+        try:
+            reps = _evaluate_reps(ast.parse(expression.strip(), mode='eval'))
+        except (SyntaxError, ValueError, RecursionError, MemoryError):
+            return float('nan')
+        # Too large for a float, reported with the other cells that could not be converted
+        return reps if np.isfinite(reps) else float('nan')
+
+    # Every distinct expression is evaluated once
+    return _to_list(values, '0', lambda sets: sets.map({expression: evaluate(expression) for expression in sets.unique()}))
+
+
+# Columns of the Sports sheet: header in Excel, name in the analysis, converter and the check reported on failure
+SCHEMA: List[Tuple[str, str, Converter, str]] = [
+    ('Group', 'group', to_text, ''),
+    ('Training time', 'training_time', to_duration, 'unparseable_time'),
+    ('Date', 'date', to_date, 'unparseable_date'),
+    ('Exercise', 'exercise', to_text, ''),
+    ('Variation', 'variation', to_text, ''),
+    ('Weight (kg)', 'weight', to_weights, 'unparseable_number'),
+    ('Reps', 'reps', to_reps, 'unparseable_number'),
+    ('Total time (minutes)', 'total_time', to_minutes, 'unparseable_time'),
+    ('Distance (km)', 'distance', to_number, 'unparseable_number'),
+    ('Speed(km/h)', 'speed', to_number, 'unparseable_number'),
+    ('Slope (degrees)', 'slope', to_text, ''),
+    ('Notes', 'notes', to_text, ''),
+]
+
+
+def _header_key(header: str) -> str:
+    # Headers are matched ignoring case and white space
+    return re.sub(r'\s+', '', str(header)).lower()
+
+
 class DataLoader:
     def __init__(self, sheet_name: str) -> None:
         self.sheet_name = sheet_name
 
     def update_data(self, file_path, sheet_name: str) -> None:
-        data = pd.read_excel(file_path, sheet_name=self.sheet_name, dtype=str)
+        # Keep the native Excel types when copying the sheet
+        data = pd.read_excel(file_path, sheet_name=self.sheet_name)
         # Save the data in specific location
         # Check if the file is accessible
         if os.access(file_path, os.W_OK):
@@ -42,41 +207,101 @@ class DataLoader:
 
         
 
-    def read_data(self) -> pd.DataFrame:
-        data = pd.read_excel('data.xlsx', sheet_name=self.sheet_name, dtype=str)
-        columns = ['group', 'training_time', 'date', 'exercise', \
-                   'variation', 'weight', 'reps', 'total_time', \
-                    'distance', 'speed', 'slope', 'notes']
-        data.columns = columns
+    def read_data(self, file_path: str = 'data.xlsx') -> pd.DataFrame:
+        # Read the native Excel values without type inference, every column is converted exactly once below
+        sheet = pd.read_excel(file_path, sheet_name=self.sheet_name, dtype=object)
+        return self.convert(sheet)
+
+    def convert(self, sheet: pd.DataFrame) -> pd.DataFrame:
+        # Also used on the chunks of large CSV and Parquet exports, see streaming.py
+        headers = {_header_key(header): header for header in sheet.columns}
+        missing = [header for header, _, _, _ in SCHEMA if _header_key(header) not in headers]
+        if missing:
+            raise ValueError(f"The sheet {self.sheet_name} is missing the columns {missing}")
+
+        data = pd.DataFrame(index=sheet.index)
+        conversion_errors = []
+        for header, column, converter, check in SCHEMA:
+            values = sheet[headers[_header_key(header)]]
+            data[column], failed = converter(values)
+            conversion_errors += [{'row': int(row), 'check': check, 'column': column, 'value': str(value).strip()}
+                                  for row, value in values[failed].items()]
+        # The failed cells travel with the data (also through the snapshot) to DataLoader.validate_data
+        data.attrs['conversion_errors'] = conversion_errors
         return data
 
     def clean_data(self, data: pd.DataFrame) -> pd.DataFrame:
         # Forward fill the 'group' and 'date' columns to handle missing values
         data['group'] = data['group'].ffill()
-        data['date'] = pd.to_datetime(data['date'].ffill())
-
-        # Fill NaN values in 'training_time' with '1:00'
-        data['training_time'] = data['training_time'].fillna('1:00')
+        data['date'] = data['date'].ffill()
 
-        # Strip whitespace from all string columns
-        data = data.apply(lambda x: x.str.strip() if x.dtype == "object" else x)
-
-        # Fill NaN values in 'weight' with '80' and replace 'body' with '80'
-        data['weight'] = data['weight'].fillna('80').replace('body', '80')
-        
-        # Fill NaN values in 'reps' with '1'
-        data['reps'] = data['reps'].fillna('0')
-        
-        # Split 'weight' and 'reps' columns by '-' and convert to lists
-        data['weight'] = data['weight'].apply(lambda x: list(map(float, x.split('-'))))
-        data['reps'] = data['reps'].apply(lambda x: list(map(eval, x.split('-'))))        
+        # Fill NaN values in 'training_time' with one hour
+        data['training_time'] = data['training_time'].fillna(pd.Timedelta(hours=1))
         return data
 
+    def validate_data(self, data: pd.DataFrame) -> pd.DataFrame:
+        # Check the cleaned data in one vectorized pass and report every offending row
+        is_run = data['exercise'] == 'Run'
+        has_time = data['total_time'].notnull()
+        has_distance = data['distance'].notnull()
+        has_speed = data['speed'].notnull()
+
+        # Pace in min per km for the runs with a time and distance
+        pace = (data['total_time'].dt.total_seconds() / 60 / data['distance']).where(is_run & (data['distance'] > 0))
+
+        checks = [
+            ('set_length_mismatch', 'reps', data['weight'].str.len() != data['reps'].str.len()),
+            ('unparseable_date', 'date', data['date'].isnull()),
+            ('impossible_pace', 'total_time', (pace < MIN_PACE) | (pace > MAX_PACE)),
+            # A pace needs two of time, distance and speed
+            ('missing_run_fields', 'total_time',
+             is_run & ~((has_time & has_distance) | (has_time & has_speed) | (has_distance & has_speed))),
+        ]
+        # The cells read_data could not convert
+        conversion_errors = pd.DataFrame(data.attrs.get('conversion_errors', []),
+                                         columns=['row', 'check', 'column', 'value'])
+        report = pd.concat([conversion_errors.loc[conversion_errors['row'].isin(data.index)]] + [
+            pd.DataFrame({'row': data.index[mask], 'check': check, 'column': column,
+                          'value': data.loc[mask, column].astype(str).values})
+            for check, column, mask in checks if mask.any()
+        ], ignore_index=True).drop_duplicates(['row', 'check', 'column'])
+        report['row'] = report['row'].astype(int)
+        # The first row in Excel holds the header
+        report.insert(1, 'excel_row', report['row'] + 2)
+        report.insert(2, 'date', data['date'].reindex(report['row']).values)
+        report.insert(3, 'exercise', data['exercise'].reindex(report['row']).values)
+        report = report.sort_values(['row', 'check'], kind='stable', ignore_index=True)
+
+        for check, count in report['check'].value_counts().items():
+            logging.warning(f"{count} rows failed the check {check}")
+        return report
+
+    def quarantine(self, data: pd.DataFrame, validation_report: pd.DataFrame) -> pd.DataFrame:
+        # Drop the rows the analysis cannot handle before building the analysis objects,
+        # the validation report still lists them so they can be fixed in the Excel file
+        rows = validation_report.loc[validation_report['check'].isin(QUARANTINED_CHECKS), 'row'].unique()
+        if not len(rows):
+            return data
+        logging.warning(f"{len(rows)} rows are left out of the analysis until they are fixed")
+        return data.drop(index=rows)
+
     
 class ExerciseAnalysis:
-    def __init__(self, data: pd.DataFrame) -> None:
+    # Assigning new data drops the results of the memoized methods
+    data = data_property()
+
+    def __init__(self, data: pd.DataFrame, store: Optional['TrainingStore'] = None,
+                 rollups: Optional['TrainingRollups'] = None, cache_size: int = 128) -> None:
+        # Results of the memoized methods, cache_size 0 turns the memoization off
+        self.cache = MemoCache(cache_size)
         self.data = data
+        # Optional SQL store the aggregations are pushed down to
+        self.store = store
+        # Materialized volume rollups, created on first use when not given
+        self.rollups = rollups
+        self.rollups_lock = threading.Lock()
 
+    @memoized
     def weight_trend_data(self, exercise: str) -> pd.DataFrame:
         exercise_data = self.data.loc[self.data['exercise'] == exercise]
         exercise_data1 = exercise_data.copy()
@@ -87,7 +312,10 @@ class ExerciseAnalysis:
         exercise_data['reps'] = exercise_data['reps'].astype(float)
         return exercise_data
 
+    @memoized
     def total_weight_lifted_last_5(self) -> pd.DataFrame:
+        if self.store is not None:
+            return self.store.total_weight_lifted(last=5)
         total_weight_lifted = pd.DataFrame()
         total_weight_lifted['exercise'] = self.data['exercise'].unique()
         for exercise in self.data['exercise'].unique():
@@ -96,7 +324,10 @@ class ExerciseAnalysis:
                 (exercise_data['weight'] * exercise_data['reps']).tail(5).sum()
         return total_weight_lifted
     
+    @memoized
     def total_weight_lifted_preceding_5(self) -> pd.DataFrame:
+        if self.store is not None:
+            return self.store.total_weight_lifted(last=5, skip=5)
         total_weight_lifted = pd.DataFrame()
         total_weight_lifted['exercise'] = self.data['exercise'].unique()
         for exercise in self.data['exercise'].unique():
@@ -109,9 +340,32 @@ class ExerciseAnalysis:
         return total_weight_lifted
     
 
+    @memoized
     def unique_exercise_data(self) -> pd.DataFrame:
+        if self.store is not None:
+            unique_exercise_data = self.store.exercise_summary(NON_WEIGHT_EXERCISES)
+        else:
+            unique_exercise_data = self._unique_exercise_data()
+        return self.exercise_summary_table(unique_exercise_data, self.total_weight_lifted_last_5(),
+                                           self.total_weight_lifted_preceding_5())
+
+    @staticmethod
+    def exercise_summary_table(unique_exercise_data: pd.DataFrame, total_weight_lifted_last_5: pd.DataFrame,
+                               total_weight_lifted_preceding_5: pd.DataFrame) -> pd.DataFrame:
+        # growth percentage of the total weight lifted in the last 5 runs compared to the preceding 5 runs
+        unique_exercise_data['growth_percentage'] = \
+            (total_weight_lifted_last_5['total_weight_lifted']) / \
+            total_weight_lifted_preceding_5['total_weight_lifted'] * 100
+
+            
+        unique_exercise_data.rename(columns={'exercise': 'Exercise', 'count': 'Count', 'max_weight': 'Max Weight', \
+                                             'max_weight_reps': 'Max Weight Reps', 'average_weight': 'Average Weight', \
+                                             'average_weight_last_5_runs': 'Average Weight Last 5 Runs','growth_percentage': 'Growth Percentage'}, inplace=True)
+        return unique_exercise_data
+
+    def _unique_exercise_data(self) -> pd.DataFrame:
         unique_exercises = self.data['exercise'].unique()
-        unique_exercises = [exercise for exercise in unique_exercises if exercise not in ['Run', 'Walk', 'Mountain walk', 'Stretch']]
+        unique_exercises = [exercise for exercise in unique_exercises if exercise not in NON_WEIGHT_EXERCISES]
         unique_exercise_data = pd.DataFrame()
         unique_exercise_data['exercise'] = unique_exercises
 
@@ -126,8 +380,8 @@ class ExerciseAnalysis:
                 unique_exercise_data.loc[unique_exercise_data['exercise'] == exercise, 'max_weight'] = max_weight
                 unique_exercise_data.loc[unique_exercise_data['exercise'] == exercise, 'max_weight_reps'] =\
                       exercise_data.loc[exercise_data['weight'] == max_weight, 'reps'].values[0]
-            except:
-                pass
+            except (IndexError, ValueError, TypeError) as e:
+                logging.warning(f"Could not determine the max weight of {exercise}: {e}")
         
         # Average weight column 
         for exercise in unique_exercises:
@@ -140,31 +394,21 @@ class ExerciseAnalysis:
             exercise_data = self.weight_trend_data(exercise)
             unique_exercise_data.loc[unique_exercise_data['exercise'] == exercise, 'average_weight_last_5_runs'] = \
                 exercise_data['weight'].tail(5).mean()
-            
-        # growth percentage of the total weight lifted in the last 5 runs compared to the preceding 5 runs
-        total_weight_lifted_last_5 = self.total_weight_lifted_last_5()
-        total_weight_lifted_preceding_5 = self.total_weight_lifted_preceding_5()
-        unique_exercise_data['growth_percentage'] = \
-            (total_weight_lifted_last_5['total_weight_lifted']) / \
-            total_weight_lifted_preceding_5['total_weight_lifted'] * 100
-
-            
-        unique_exercise_data.rename(columns={'exercise': 'Exercise', 'count': 'Count', 'max_weight': 'Max Weight', \
-                                             'max_weight_reps': 'Max Weight Reps', 'average_weight': 'Average Weight', \
-                                             'average_weight_last_5_runs': 'Average Weight Last 5 Runs','growth_percentage': 'Growth Percentage'}, inplace=True)
         return unique_exercise_data
 
+    @memoized
     def group_exercise_data(self) -> pd.DataFrame:
-        self.data['group'] = self.data['group'].fillna('No group')
+        # Fill the missing groups in a copy of the column, self.data is left as it is
+        groups = self.data['group'].fillna('No group')
         group_exercise_data = pd.DataFrame()
         # Find the unique groups in the data by splicing and exploding the 'group' column
-        unique_groups = self.data['group'].str.split('+').explode()
+        unique_groups = groups.str.split('+').explode()
         unique_groups = unique_groups.str.strip().unique()
 
 
         group_exercise_data['group'] = unique_groups
         for group in unique_groups:
-            group_data = self.data.loc[self.data['group'] == group]
+            group_data = self.data.loc[groups == group]
             group_exercise_data.loc[group_exercise_data['group'] == group, 'count'] = len(group_data)
             group_exercise_data.loc[group_exercise_data['group'] == group, 'average_weight'] = \
                 group_data['weight'].apply(lambda x: sum(x) / len(x)).mean()
@@ -173,7 +417,10 @@ class ExerciseAnalysis:
             group_exercise_data.loc[group_exercise_data['group'] == group, 'growth_percentage'] = \
                 (group_exercise_data.loc[group_exercise_data['group'] == group, 'average_weight_last_5'].values[0] / \
                     group_exercise_data.loc[group_exercise_data['group'] == group, 'average_weight'].values[0]) * 100
-            
+        return self.group_summary_table(group_exercise_data)
+
+    @staticmethod
+    def group_summary_table(group_exercise_data: pd.DataFrame) -> pd.DataFrame:
         # Round the growth percentage to 2 decimal places
         group_exercise_data['growth_percentage'] = group_exercise_data['growth_percentage'].round(2)
 
@@ -184,11 +431,36 @@ class ExerciseAnalysis:
         return group_exercise_data
     
     
-    def plot_weight_trend(self, exercise: str) -> Tuple[plt.Figure, plt.Axes]:
+    @memoized
+    def weight_trend_fits(self, horizon_days: int = 28, robust: bool = False) -> pd.DataFrame:
+        # One line through the weights of all sets per exercise, all exercises in one batched fit
+        data = self.data.loc[~self.data['exercise'].isin(NON_WEIGHT_EXERCISES), ['exercise', 'date', 'weight']]
+        sets = data.explode('weight')
+        return trends.fit_trends(sets['exercise'], sets['date'], sets['weight'].astype(float), horizon_days, robust)
+
+    @memoized
+    def weight_progression(self, horizon_days: int = 28, robust: bool = False) -> pd.DataFrame:
+        weight_progression = self.weight_trend_fits(horizon_days, robust)[
+            ['points', 'slope_per_week', 'forecast_date', 'forecast', 'lower', 'upper']].reset_index()
+        weight_progression[['slope_per_week', 'forecast', 'lower', 'upper']] = \
+            weight_progression[['slope_per_week', 'forecast', 'lower', 'upper']].round(2)
+        weight_progression.rename(columns={'exercise': 'Exercise', 'points': 'Sets', 'slope_per_week': 'Slope (kg per week)', \
+                                           'forecast_date': 'Forecast Date', 'forecast': 'Forecast (kg)', \
+                                           'lower': 'Forecast Lower (kg)', 'upper': 'Forecast Upper (kg)'}, inplace=True)
+        return weight_progression
+
+    def plot_weight_trend(self, exercise: str, trend: bool = False) -> Tuple[plt.Figure, plt.Axes]:
         exercise_data = self.weight_trend_data(exercise)
         fig, ax = plt.subplots()
         ax.scatter(exercise_data['date'], exercise_data['weight'], s=exercise_data['reps']*10, \
                    c=exercise_data['reps'], cmap='rainbow', alpha=0.5)
+        # Overlay the fitted line, the forecast and its 95% prediction band
+        trend_line = trends.trend_line(self.weight_trend_fits(), exercise) if trend else None
+        if trend_line is not None:
+            ax.plot(trend_line['date'], trend_line['fit'], 'k--', label='Trend and forecast')
+            ax.fill_between(trend_line['date'], trend_line['lower'], trend_line['upper'], color='grey', alpha=0.2,
+                            label='95% prediction band')
+            ax.legend()
         ax.set_xlabel('Date')
         ax.set_ylabel('Weight (kg)')
         colorbar = plt.colorbar(ax.collections[0])
@@ -201,51 +473,125 @@ class ExerciseAnalysis:
         ax.set_xticklabels(ax.get_xticks(), rotation=45)  # Now set the labels with rotation
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%b-%d'))
         return fig, ax
+
+    def weight_trend_chart(self, exercise: str, trend: bool = False) -> Dict:
+        # Vega-Lite spec of plot_weight_trend, rendered in the browser
+        trend_line = trends.trend_line(self.weight_trend_fits(), exercise) if trend else None
+        return charts.weight_trend_spec(self.weight_trend_data(exercise), exercise, trend_line)
+
+    def _shared_rollups(self) -> 'TrainingRollups':
+        # Created once, also when several sessions render the volume panel at the same time
+        with self.rollups_lock:
+            if self.rollups is None:
+                from rollups import TrainingRollups
+                self.rollups = TrainingRollups()
+        return self.rollups
+
+    def volume_rollup(self, period: str = 'week', by: str = 'exercise') -> pd.DataFrame:
+        rollups = self._shared_rollups()
+        # Reading does not scan the history, the tables are only updated when built from other data
+        if not rollups.is_current(self.data):
+            rollups.update(self.data)
+        return rollups.rollup(period, by)[['volume', 'sets']]
+
+    def plot_volume_heatmap(self, period: str = 'week', by: str = 'group') -> Tuple[plt.Figure, plt.Axes]:
+        volume = self.volume_rollup(period, by)['volume'].unstack(by, fill_value=0).T
+        volume = volume.loc[volume.sum(axis=1) > 0]
+        # Show the periods without training as empty columns
+        frequency = {'day': 'D', 'week': 'W-MON', 'month': 'MS'}[period]
+        if len(volume.columns):
+            periods = pd.date_range(volume.columns.min(), volume.columns.max(), freq=frequency)
+            volume = volume.reindex(columns=periods, fill_value=0)
+        fig, ax = plt.subplots()
+        image = ax.imshow(volume.values, aspect='auto', cmap='YlOrRd', interpolation='nearest')
+        colorbar = plt.colorbar(image)
+        colorbar.set_label('Volume (kg)')
+        ax.set_yticks(range(len(volume.index)))
+        ax.set_yticklabels(volume.index)
+
+        # Label at most 12 periods on the x-axis
+        step = max(len(volume.columns) // 12, 1)
+        ax.set_xticks(range(0, len(volume.columns), step))
+        ax.set_xticklabels([d.strftime('%b-%d') for d in volume.columns[::step]], rotation=45)
+        ax.set_xlabel(period.capitalize())
+        ax.set_title(f'Training volume per {period} and {by}')
+        return fig, ax
         
 class RunAnalysis:
-    def __init__(self, data: pd.DataFrame) -> None:
+    # Assigning new data drops the results of the memoized methods
+    data = data_property()
+
+    def __init__(self, data: pd.DataFrame, store: Optional['TrainingStore'] = None,
+                 rollups: Optional['TrainingRollups'] = None, cache_size: int = 128) -> None:
+        # Results of the memoized methods, cache_size 0 turns the memoization off
+        self.cache = MemoCache(cache_size)
         self.data = data
+        # Optional SQL store the aggregations are pushed down to
+        self.store = store
+        # Materialized volume rollups, created on first use when not given
+        self.rollups = rollups
+        self.rollups_lock = threading.Lock()
 
 
+    @memoized
     def running_data(self) -> pd.DataFrame:
         # Find all Run exercises in the data
         running_data = self.data.loc[self.data['exercise'] == 'Run'].copy()
-        # Change the format of the total time 
-        running_data.loc[:, 'total_time'] = running_data['total_time'].astype(str)
-        # Convert 'total_time' from MM:ss to seconds
-        if 'total_time_delta' not in running_data.columns:
-            running_data['total_time_delta'] = pd.Series(dtype='timedelta64[ns]')       
-        running_data.loc[:, 'total_time_delta'] = running_data['total_time'].apply(
-            lambda x: int(x.split(':')[0]) * 60 + int(x.split(':')[1]) if pd.notnull(x) else 0
-        )
-
-        # Convert 'total_time_delta' to a timedelta object
-        running_data['total_time_delta'] = pd.to_timedelta(running_data['total_time_delta'], unit='s')
-
+        total_time = running_data['total_time'].fillna(pd.Timedelta(0))
+        has_time = total_time != pd.Timedelta(0)
+        has_distance = running_data['distance'].notnull()
+        has_speed = running_data['speed'].notnull()
 
         # Calculate speed and distance based on available data
-        for k, v in running_data.loc[:, ['date', 'total_time_delta', 'distance', 'speed']].iterrows():
-            if v['total_time_delta'] != pd.Timedelta(seconds=0) and pd.notnull(v['distance']):
-                running_data.loc[k, 'speed'] = float(v['distance']) / (float(v['total_time_delta'].total_seconds()) / 3600)
-            elif v['total_time_delta'] != pd.Timedelta(seconds=0) and pd.notnull(v['speed']):
-                pass # speed is already calculated
-            #     # Ensure 'v['speed']' is treated as a float
-            #     speed_as_float = float(v['speed'])
-            #     running_data.loc[k, 'distance'] = speed_as_float * (v['total_time_delta'].seconds / 3600)   
-            elif pd.notnull(v['distance']) and pd.notnull(v['speed']):
-                running_data.loc[k, 'total_time_delta'] = pd.to_timedelta(seconds=(v['distance'] / v['speed']) * 3600, unit='s')
-            else:
-                logging.warning(f"Row {k} has missing values for 'total_time_delta', 'distance', and 'speed'")
+        hours = total_time.dt.total_seconds() / 3600
+        running_data['speed'] = running_data['speed'].mask(has_time & has_distance, running_data['distance'] / hours)
+        # Without a time, the time follows from the distance and the speed
+        from_speed = ~has_time & has_distance & has_speed
+        total_time = total_time.mask(from_speed, pd.to_timedelta(
+            running_data['distance'] / running_data['speed'] * 3600, unit='s'))
+        for k in running_data.index[~has_time & ~from_speed]:
+            logging.warning(f"Row {k} has missing values for 'total_time_delta', 'distance', and 'speed'")
+        running_data['total_time_delta'] = total_time
 
         # Calculate pace for each row
         total_seconds = running_data['total_time_delta'].dt.total_seconds()
-        running_data['distance_float'] = running_data['distance'].astype(float)
-        valid_times = total_seconds != 0
-        running_data.loc[valid_times, 'pace'] = \
-            (total_seconds[valid_times] / 60) / running_data.loc[valid_times, 'distance_float']
+        running_data['pace'] = ((total_seconds / 60) / running_data['distance']).where(total_seconds != 0)
         return running_data
 
+    @memoized
     def unique_running_data(self) -> pd.DataFrame:
+        if self.store is not None:
+            unique_running_data = self.store.running_summary()
+            unique_running_data['percentage_change'] = \
+                unique_running_data['average_pace'] / unique_running_data['average_pace_last_5_runs'] * 100
+        else:
+            unique_running_data = self._unique_running_data()
+        return self.running_summary_table(unique_running_data)
+
+    @staticmethod
+    def running_summary_table(unique_running_data: pd.DataFrame) -> pd.DataFrame:
+        # Round percentage change to 2 decimal places
+        unique_running_data['percentage_change'] = unique_running_data['percentage_change'].round(2)
+
+
+
+        # Convert pace from seconds to mm:ss
+        def pace_seconds_to_mm_ss(column_name: str) -> None:
+            unique_running_data[column_name] = unique_running_data[column_name].apply(
+            lambda x: f"{int(x)}:{int((x - int(x)) * 60):02d}"
+            ) 
+        # Min pace format to mm:ss
+        pace_seconds_to_mm_ss('min_pace')
+        # Average pace format to mm:ss
+        pace_seconds_to_mm_ss('average_pace')
+        # Average pace last 5 runs format to mm:ss
+        pace_seconds_to_mm_ss('average_pace_last_5_runs')
+
+        unique_running_data.rename(columns={'distance': 'Distance (km)', 'count': 'Count', 'min_pace': 'Min Pace', \
+                                            'average_pace': 'Average Pace', 'average_pace_last_5_runs': 'Average Pace last 5 runs'}, inplace=True)
+        return unique_running_data
+
+    def _unique_running_data(self) -> pd.DataFrame:
         running_data = self.running_data()
         unique_running_data = pd.DataFrame()
         unique_running_data['distance'] = running_data['distance'].unique()
@@ -268,38 +614,45 @@ class RunAnalysis:
                 unique_running_data.loc[unique_running_data['distance'] == distance, 'percentage_change'] = \
                     (unique_running_data.loc[unique_running_data['distance'] == distance, 'average_pace'].values[0] / \
                     unique_running_data.loc[unique_running_data['distance'] == distance, 'average_pace_last_5_runs'].values[0]) * 100
-                
-        # Round percentage change to 2 decimal places
-        unique_running_data['percentage_change'] = unique_running_data['percentage_change'].round(2)
-
-
-
-        # Convert pace from seconds to mm:ss
-        def pace_seconds_to_mm_ss(column_name: str) -> None:
-            unique_running_data[column_name] = unique_running_data[column_name].apply(
-            lambda x: f"{int(x)}:{int((x - int(x)) * 60):02d}"
-            ) 
-        # Min pace format to mm:ss
-        pace_seconds_to_mm_ss('min_pace')
-        # Average pace format to mm:ss
-        pace_seconds_to_mm_ss('average_pace')
-        # Average pace last 5 runs format to mm:ss
-        pace_seconds_to_mm_ss('average_pace_last_5_runs')
-
-        unique_running_data.rename(columns={'distance': 'Distance (km)', 'count': 'Count', 'min_pace': 'Min Pace', \
-                                            'average_pace': 'Average Pace', 'average_pace_last_5_runs': 'Average Pace last 5 runs'}, inplace=True)
         return unique_running_data
 
-    def plot_pace_trend(self, distance: Union[str, List[str]] = '3') -> Tuple[plt.Figure, plt.Axes]:
-        if isinstance(distance, str):
+    @memoized
+    def pace_trend_fits(self, horizon_days: int = 28, robust: bool = False) -> pd.DataFrame:
+        # One line through the paces per distance, all distances in one batched fit
+        running_data = self.running_data()
+        return trends.fit_trends(running_data['distance'], running_data['date'], running_data['pace'],
+                                 horizon_days, robust)
+
+    @memoized
+    def pace_progression(self, horizon_days: int = 28, robust: bool = False) -> pd.DataFrame:
+        # A negative slope means the runs get faster
+        pace_progression = self.pace_trend_fits(horizon_days, robust)[
+            ['points', 'slope_per_week', 'forecast_date', 'forecast', 'lower', 'upper']].reset_index()
+        pace_progression[['slope_per_week', 'forecast', 'lower', 'upper']] = \
+            pace_progression[['slope_per_week', 'forecast', 'lower', 'upper']].round(3)
+        pace_progression.rename(columns={'distance': 'Distance (km)', 'points': 'Runs', \
+                                         'slope_per_week': 'Slope (min per km per week)', 'forecast_date': 'Forecast Date', \
+                                         'forecast': 'Forecast Pace', 'lower': 'Forecast Lower', 'upper': 'Forecast Upper'}, inplace=True)
+        return pace_progression
+
+    def plot_pace_trend(self, distance: Union[float, List[float]] = 3.0, trend: bool = False) -> Tuple[plt.Figure, plt.Axes]:
+        if not isinstance(distance, (list, tuple)):
             distance = [distance]
+        distance = [float(d) for d in distance]
         run_data = self.running_data()
         run_data = run_data.loc[run_data['distance'].isin(distance)]
         fig, ax = plt.subplots()
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%b-%d'))
+        trend_lines = trends.trend_lines(self.pace_trend_fits()) if trend else None
         for d in distance:
-            ax.plot(run_data.loc[run_data['distance'] == d, 'date'], run_data.loc[
-                run_data['distance'] == d, 'pace'], '-', marker='o', label=f'{d} km')
+            line, = ax.plot(run_data.loc[run_data['distance'] == d, 'date'], run_data.loc[
+                run_data['distance'] == d, 'pace'], '-', marker='o', label=f'{d:g} km')
+            # Overlay the fitted line, the forecast and its 95% prediction band in the color of the distance
+            if trend_lines is not None and (trend_lines['distance'] == d).any():
+                trend_line = trend_lines.loc[trend_lines['distance'] == d]
+                ax.plot(trend_line['date'], trend_line['fit'], '--', color=line.get_color())
+                ax.fill_between(trend_line['date'], trend_line['lower'], trend_line['upper'],
+                                color=line.get_color(), alpha=0.15)
         ax.set_xlabel('Date')
         ax.set_ylabel('Pace (min per km)')
         ax.set_title(f'Pace trend for different distances')
@@ -307,6 +660,35 @@ class RunAnalysis:
         ax.legend()
         return fig, ax
 
+    def pace_trend_chart(self, distance: Union[float, List[float], None] = None, trend: bool = False,
+                         selected: Optional[float] = None) -> Dict:
+        # Vega-Lite spec of plot_pace_trend, without a distance the chart holds all distances
+        # and shows the selected one first, the others are picked in the chart
+        if distance is not None and not isinstance(distance, (list, tuple)):
+            distance = [distance]
+        distance = None if distance is None else [float(d) for d in distance]
+        trend_lines = trends.trend_lines(self.pace_trend_fits()) if trend else None
+        if trend_lines is not None and distance is not None:
+            trend_lines = trend_lines.loc[trend_lines['distance'].isin(distance)]
+        return charts.pace_trend_spec(self.running_data(), distance, trend_lines, selected)
+
+    def _shared_rollups(self) -> 'TrainingRollups':
+        # Created once, also when several threads ask for a rollup at the same time
+        with self.rollups_lock:
+            if self.rollups is None:
+                from rollups import TrainingRollups
+                self.rollups = TrainingRollups()
+        return self.rollups
+
+    def running_rollup(self, period: str = 'week') -> pd.DataFrame:
+        rollups = self._shared_rollups()
+        # Reading does not scan the history, the tables are only updated when built from other data
+        if not rollups.is_current(self.data):
+            rollups.update(self.data)
+        running_rollup = rollups.rollup(period, 'exercise')
+        running_rollup = running_rollup.loc[running_rollup['runs'] > 0, ['runs', 'distance_km', 'time_minutes']]
+        return running_rollup.droplevel('exercise')
+
 #%%
 if __name__ == "__main__":
     # Load and clean the data
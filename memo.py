@@ -0,0 +1,144 @@
+""" Per-instance memoization of the analysis methods.
+
+    ExerciseAnalysis and RunAnalysis keep a MemoCache with the results of their methods,
+    keyed by the method and its arguments. Assigning self.data drops all cached results at once,
+    and every lookup compares the version token of the data with the token the cached results
+    were computed for:
+    - assigning a column or appending rows changes the shape or the column arrays
+    - writing cells in place (data.loc[mask, 'weight'] = ...) changes the fingerprint of the
+      column, a CRC of the raw column buffer: the values of number and date columns and the
+      object pointers of text and list columns, about 1.5 ms per million cells
+    - repopulating the SQL store changes the token through TrainingStore.version
+    and a changed token drops all cached results. The token is computed once per call, a memoized
+    method calling other memoized methods of the same instance reuses the token of the outer call.
+    Changing a list inside a cell in place (data.at[i, 'weight'][0] = ...) keeps the object and is
+    not detected; the list cells read from the snapshot are read-only numpy arrays.
+
+    The least recently used result is evicted once the cache holds maxsize results,
+    maxsize 0 turns the memoization off. DataFrames and Series are copied on the way in and out,
+    so callers may modify what they get back.
+    """
+#%%
+import zlib
+import ctypes
+import threading
+import functools
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def fingerprint(values: Any) -> int:
+    # CRC of the raw buffer of a column, for object columns the buffer holds the pointers to the cells
+    if not isinstance(values, np.ndarray):
+        # Extension arrays are hashed value by value
+        return zlib.crc32(pd.util.hash_array(values))
+    values = np.ascontiguousarray(values)
+    if values.dtype == object:
+        return zlib.crc32(ctypes.string_at(values.ctypes.data, values.nbytes))
+    return zlib.crc32(values.view(np.uint8))
+
+
+def data_version(data: pd.DataFrame, store: Optional[Any] = None) -> Tuple:
+    # Identity, shape, columns, the address and the fingerprint of every column array
+    columns = [data[column].values for column in data.columns]
+    addresses = tuple(values.__array_interface__['data'][0] if hasattr(values, '__array_interface__')
+                      else id(values) for values in columns)
+    return (id(data), data.shape, tuple(data.columns), addresses, tuple(fingerprint(values) for values in columns),
+            id(store), getattr(store, 'version', None))
+
+
+def _freeze(value: Any) -> Hashable:
+    # Lists of distances or exercises become tuples so they can be part of the key
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _copy(value: Any) -> Any:
+    return value.copy() if isinstance(value, (pd.DataFrame, pd.Series)) else value
+
+
+class MemoCache:
+    def __init__(self, maxsize: int = 128) -> None:
+        self.maxsize = maxsize
+        self.results: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self.version: Optional[Tuple] = None
+        # The instances are shared between the dashboard sessions and the API threads
+        self.lock = threading.Lock()
+        # Version token of the memoized call running in this thread, reused by the calls it makes
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable, version: Tuple, compute: Callable[[], Any]) -> Any:
+        if self.maxsize <= 0:
+            return compute()
+        with self.lock:
+            if version != self.version:
+                # The data changed, nothing computed before is valid anymore
+                if self.results:
+                    self.invalidations += 1
+                self.results.clear()
+                self.version = version
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return _copy(self.results[key])
+            self.misses += 1
+
+        # Computed outside the lock, two threads missing the same key both compute it
+        result = compute()
+        with self.lock:
+            if version == self.version:
+                self.results[key] = _copy(result)
+                self.results.move_to_end(key)
+                while len(self.results) > self.maxsize:
+                    self.results.popitem(last=False)
+                    self.evictions += 1
+        return result
+
+    def clear(self) -> None:
+        with self.lock:
+            self.results.clear()
+            self.version = None
+
+    def info(self) -> Dict[str, int]:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self.results), 'maxsize': self.maxsize}
+
+
+def data_property() -> property:
+    # self.data of the classes with a MemoCache, assigning new data drops the cached results right away
+    def get_data(self) -> pd.DataFrame:
+        return self._data
+
+    def set_data(self, data: pd.DataFrame) -> None:
+        self._data = data
+        self.cache.clear()
+    return property(get_data, set_data)
+
+
+def memoized(method: Callable) -> Callable:
+    # For methods of classes with self.data, self.cache and optionally self.store
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache.maxsize <= 0:
+            return method(self, *args, **kwargs)
+        key = (method.__name__, _freeze(args), _freeze(kwargs))
+        outer_version = getattr(self.cache.local, 'version', None)
+        # The data cannot change halfway through a call, the calls it makes reuse its token
+        version = outer_version or data_version(self.data, getattr(self, 'store', None))
+        self.cache.local.version = version
+        try:
+            return self.cache.get(key, version, lambda: method(self, *args, **kwargs))
+        finally:
+            self.cache.local.version = outer_version
+    return wrapper
@@ -0,0 +1,172 @@
+""" Materialized training-volume rollups.
+
+    The rollups hold per day, week and month:
+    - volume: the weight times the reps summed over all sets
+    - sets: the number of sets
+    - runs, distance_km and time_minutes: the number, distance and time of the runs
+    broken down by exercise and by group, where a session with the group 'Back + Chest'
+    counts towards both groups.
+
+    TrainingRollups.update only aggregates the rows it has not seen before and adds them
+    to the stored tables, reading a rollup returns the stored table without touching the
+    training history. is_current tells a reader in constant time whether the tables were
+    built from a DataFrame, by its identity and row count, so reads never scan the history. One instance is shared by the dashboard sessions, a lock makes every
+    update read, aggregate, add and advance as one step.
+
+    The update checks that the history only grew at the end: the CRCs of the contents of the
+    rows processed so far must match the CRCs of the same rows in the new data. Equal rows give
+    equal CRCs also when they come from another snapshot version, so the rollups carry over from
+    one version to the next. Edited or removed rows make the update rebuild the tables.
+    An unchanged DataFrame is recognized by its version token and skips the check.
+    """
+#%%
+import zlib
+import logging
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from main import RunAnalysis, NON_WEIGHT_EXERCISES, ANALYSIS_COLUMNS
+from memo import data_version
+
+PERIODS = ['day', 'week', 'month']
+BREAKDOWNS = ['exercise', 'group']
+COLUMNS = ['volume', 'sets', 'runs', 'distance_km', 'time_minutes']
+# The rollups read the analysis columns, the list columns hold one value per set
+LIST_COLUMNS = ['weight', 'reps']
+# One CRC for the other columns and two for each list column, the lengths and the values
+EMPTY_FINGERPRINTS = (0,) * (1 + 2 * len(LIST_COLUMNS))
+
+
+def period_start(dates: pd.Series, period: str) -> pd.Series:
+    dates = dates.dt.normalize()
+    if period == 'day':
+        return dates
+    if period == 'week':
+        # Weeks start on Monday
+        return dates - pd.to_timedelta(dates.dt.weekday, unit='D')
+    if period == 'month':
+        return dates.dt.to_period('M').dt.to_timestamp()
+    raise ValueError(f"Unknown period {period}, expected one of {PERIODS}")
+
+
+def history_fingerprints(data: pd.DataFrame, previous: Tuple[int, ...] = EMPTY_FINGERPRINTS) -> Tuple[int, ...]:
+    # CRCs of the contents of the rows, continued from the CRCs of the rows before them
+    scalars = [column for column in ANALYSIS_COLUMNS if column not in LIST_COLUMNS]
+    streams = [pd.util.hash_pandas_object(data[scalars], index=False).to_numpy()]
+    for column in LIST_COLUMNS:
+        cells = data[column].to_list()
+        streams.append(np.array([len(cell) for cell in cells], dtype=np.int64))
+        streams.append(np.concatenate(cells).astype(float) if cells else np.empty(0))
+    return tuple(zlib.crc32(stream, crc) for stream, crc in zip(streams, previous))
+
+
+class TrainingRollups:
+    def __init__(self) -> None:
+        # Two sessions updating at the same time would both add the same rows
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        # One table per period and breakdown, indexed by (period start, exercise or group)
+        self.tables: Dict[Tuple[str, str], pd.DataFrame] = {
+            (period, by): self._empty_table(by) for period in PERIODS for by in BREAKDOWNS
+        }
+        # Number of rows of the training history already added to the tables and the CRCs of their contents
+        self.rows_processed = 0
+        self.fingerprints = EMPTY_FINGERPRINTS
+        # Version token of the DataFrame the tables are up to date with and a reference to that DataFrame
+        self.data_version: Optional[Tuple] = None
+        self.source: Optional[weakref.ref] = None
+
+    @staticmethod
+    def _empty_table(by: str) -> pd.DataFrame:
+        index = pd.MultiIndex.from_arrays([pd.DatetimeIndex([]), pd.Index([], dtype=object)], names=['period', by])
+        return pd.DataFrame({column: pd.Series(dtype=float) for column in COLUMNS}, index=index)
+
+    def rebuild(self, data: pd.DataFrame) -> None:
+        with self.lock:
+            self._reset()
+            self._append(data, data_version(data))
+
+    def update(self, data: pd.DataFrame) -> None:
+        with self.lock:
+            version = data_version(data)
+            if version == self.data_version:
+                return
+            # The training history only grows at the end, the new sessions are the rows not processed yet
+            if len(data) < self.rows_processed or \
+                    history_fingerprints(data.iloc[:self.rows_processed]) != self.fingerprints:
+                logging.info(f"Rows among the first {self.rows_processed} of the training history were changed or removed, "
+                             f"rebuilding the rollups")
+                self._reset()
+            self._append(data, version)
+
+    def _append(self, data: pd.DataFrame, version: Tuple) -> None:
+        # Called with the lock held
+        new_rows = data.iloc[self.rows_processed:]
+        self._add(new_rows)
+        self.fingerprints = history_fingerprints(new_rows, self.fingerprints)
+        self.data_version = version
+        self.source = weakref.ref(data)
+
+    def is_current(self, data: pd.DataFrame) -> bool:
+        # Constant time, in-place writes to the same DataFrame are only noticed by update
+        source = self.source() if self.source is not None else None
+        return source is data and self.rows_processed == len(data)
+
+    def _add(self, new_rows: pd.DataFrame) -> None:
+        if new_rows.empty:
+            return
+        rows = self._row_totals(new_rows)
+        for period in PERIODS:
+            rows['period'] = period_start(rows['date'], period)
+            for by in BREAKDOWNS:
+                delta = rows.explode(by) if by == 'group' else rows
+                delta = delta.groupby(['period', by])[COLUMNS].sum()
+                table = self.tables[(period, by)]
+                self.tables[(period, by)] = table.add(delta, fill_value=0) if len(table) else delta
+        self.rows_processed += len(new_rows)
+
+    def copy(self) -> 'TrainingRollups':
+        # The tables are replaced on every update and never changed in place, the copy shares them
+        with self.lock:
+            rollups = TrainingRollups()
+            rollups.tables = dict(self.tables)
+            rollups.rows_processed, rollups.fingerprints, rollups.data_version, rollups.source = \
+                self.rows_processed, self.fingerprints, self.data_version, self.source
+        return rollups
+
+    @staticmethod
+    def _row_totals(data: pd.DataFrame) -> pd.DataFrame:
+        # Volume and set count per row, the weight and reps lists are paired by position
+        is_weighted = ~data['exercise'].isin(NON_WEIGHT_EXERCISES)
+        volume = [sum(w * r for w, r in zip(weight, reps)) for weight, reps in zip(data['weight'], data['reps'])]
+        rows = pd.DataFrame({
+            'date': data['date'],
+            'exercise': data['exercise'].fillna('No exercise'),
+            'group': data['group'].fillna('No group').str.split('+').apply(lambda x: [g.strip() for g in x]),
+            'volume': pd.Series(volume, index=data.index, dtype=float).where(is_weighted, 0.0),
+            'sets': data['weight'].str.len().where(is_weighted, 0).astype(float),
+            'runs': 0.0,
+            'distance_km': 0.0,
+            'time_minutes': 0.0,
+        }, index=data.index)
+
+        # Distance and time of the runs
+        if (data['exercise'] == 'Run').any():
+            running_data = RunAnalysis(data).running_data()
+            rows.loc[running_data.index, 'runs'] = 1.0
+            rows.loc[running_data.index, 'distance_km'] = running_data['distance'].fillna(0).values
+            rows.loc[running_data.index, 'time_minutes'] = \
+                running_data['total_time_delta'].dt.total_seconds().fillna(0).values / 60
+        return rows
+
+    def rollup(self, period: str = 'week', by: str = 'exercise') -> pd.DataFrame:
+        if (period, by) not in self.tables:
+            raise ValueError(f"Unknown rollup {period}/{by}, expected a period in {PERIODS} and a breakdown in {BREAKDOWNS}")
+        with self.lock:
+            return self.tables[(period, by)]
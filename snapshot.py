@@ -0,0 +1,188 @@
+""" Shared snapshot of the cleaned sports data.
+
+    The cleaned set-level data produced by DataLoader.clean_data is published as an
+    Arrow IPC file which the dashboard, the API and batch jobs open through a memory map,
+    read_table gives an Arrow table whose buffers are the shared pages of the file.
+
+    read_data builds the pandas DataFrame the analysis classes work on. That DataFrame is private
+    to the process, the dashboard and the API build it once per process and snapshot version.
+    Only the requested columns are converted: dates, times and numbers without missing values
+    stay views on the mapped pages, the weights and reps of a row are numpy arrays pointing into
+    the file, the text columns and the per-row array objects are allocated by the process.
+
+    Every publish writes a new immutable file 'sports-<version>.arrow' and then swaps the
+    'CURRENT' pointer file by an atomic rename. A reader resolves the pointer once and keeps
+    reading that version, so a refresh that runs at the same time never gives a mixed view.
+    Publishes from several processes are serialized by a lock file, the versions only grow
+    and the version 'CURRENT' names is never pruned.
+    """
+#%%
+import os
+import time
+import logging
+import tempfile
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+
+from main import DataLoader
+
+POINTER_FILE = 'CURRENT'
+LOCK_FILE = 'PUBLISH.lock'
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# Arrow types of the cleaned data, the list columns hold one value per set
+SCHEMA = pa.schema([
+    ('group', pa.string()),
+    ('training_time', pa.duration('ns')),
+    ('date', pa.timestamp('ns')),
+    ('exercise', pa.string()),
+    ('variation', pa.string()),
+    ('weight', pa.list_(pa.float64())),
+    ('reps', pa.list_(pa.float64())),
+    ('total_time', pa.duration('ns')),
+    ('distance', pa.float64()),
+    ('speed', pa.float64()),
+    ('slope', pa.string()),
+    ('notes', pa.string()),
+])
+
+
+class ArrowSnapshot:
+    def __init__(self, directory: str = 'snapshots', keep: int = 2) -> None:
+        self.directory = directory
+        # Number of versions kept on disk, older ones may still be mapped by slow readers
+        self.keep = keep
+
+    def _version_path(self, version: str) -> str:
+        return os.path.join(self.directory, f'sports-{version}.arrow')
+
+    @contextmanager
+    def _publish_lock(self) -> Iterator[None]:
+        # Held across the version choice, the renames and the pruning, released if the process dies
+        with open(os.path.join(self.directory, LOCK_FILE), 'a+b') as f:
+            if os.name == 'nt':
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after 10 seconds, keep waiting for the other publisher
+                        pass
+            else:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if os.name == 'nt':
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write_temp(self, write: Callable[[str], None]) -> str:
+        # Every publisher gets its own temporary file in the directory, so the renames stay atomic
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        # mkstemp creates the file private to the user, the snapshots are read by other processes
+        os.chmod(tmp_path, 0o644)
+        try:
+            write(tmp_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def publish(self, data: pd.DataFrame) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        table = pa.Table.from_pandas(data[SCHEMA.names], schema=SCHEMA, preserve_index=False)
+
+        # Write the new version outside the lock, readers never see a partial file
+        def write_table(tmp_path: str) -> None:
+            with pa.OSFile(tmp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        tmp_path = self._write_temp(write_table)
+
+        with self._publish_lock():
+            # The new version sorts after every version on disk, so CURRENT never moves back
+            versions = self.versions()
+            latest = int(versions[-1]) if versions else 0
+            version = f'{max(time.time_ns(), latest + 1):020d}'
+            os.replace(tmp_path, self._version_path(version))
+
+            # Swap the pointer to the new version by an atomic rename
+            def write_pointer(pointer_tmp: str) -> None:
+                with open(pointer_tmp, 'w') as f:
+                    f.write(version)
+            os.replace(self._write_temp(write_pointer), os.path.join(self.directory, POINTER_FILE))
+
+            logging.info(f"Published snapshot {version} with {table.num_rows} rows")
+            self._prune(version)
+        return version
+
+    def versions(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[len('sports-'):-len('.arrow')] for name in os.listdir(self.directory)
+                      if name.startswith('sports-') and name.endswith('.arrow'))
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, POINTER_FILE)) as f:
+                version = f.read().strip() or None
+        except FileNotFoundError:
+            return None
+        if version is None:
+            return None
+        try:
+            source = pa.memory_map(self._version_path(version), 'r')
+        except FileNotFoundError:
+            # The pointer names a file that was removed, the callers publish a new one
+            logging.warning(f"Snapshot {version} named by {POINTER_FILE} is missing")
+            return None
+        # A snapshot written with an older schema is treated as missing, so the callers publish a new one
+        if not pa.ipc.open_file(source).schema.equals(SCHEMA):
+            logging.warning(f"Snapshot {version} has an outdated schema and is ignored")
+            return None
+        return version
+
+    def read_table(self, version: Optional[str] = None) -> pa.Table:
+        if version is None:
+            version = self.current_version()
+        if version is None:
+            raise FileNotFoundError(f"No snapshot has been published in {self.directory}")
+        # The table buffers point directly into the mapped file, nothing is copied
+        source = pa.memory_map(self._version_path(version), 'r')
+        return pa.ipc.open_file(source).read_all()
+
+    def read_data(self, version: Optional[str] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        # The list columns come back as numpy arrays, which the analysis classes handle as lists
+        table = self.read_table(version)
+        if columns is not None:
+            table = table.select(columns)
+        # One block per column, consolidating the columns into one block would copy them all
+        return table.to_pandas(split_blocks=True)
+
+    def _prune(self, current: str) -> None:
+        for version in self.versions()[:-self.keep]:
+            if version == current:
+                continue
+            try:
+                os.remove(self._version_path(version))
+            except OSError:
+                # The file is still mapped by a reader (Windows), remove it on the next publish
+                pass
+
+
+#%%
+if __name__ == "__main__":
+    # Rebuild the snapshot from data.xlsx
+    loader = DataLoader('Sports')
+    ArrowSnapshot().publish(loader.clean_data(loader.read_data()))
@@ -0,0 +1,208 @@
+""" Embedded SQL store for the training history.
+
+    The cleaned data from DataLoader is written to a single SQLite file with three indexed tables:
+    - sessions: one row per training day and group
+    - sets: one row per set, the weight and reps lists of a row are paired by position
+    - runs: one row per run with the total time in seconds and the pace in minutes per km
+
+    ExerciseAnalysis and RunAnalysis accept a TrainingStore and push their aggregations down
+    to it, ad hoc questions can be asked through TrainingStore.query.
+    """
+#%%
+import sqlite3
+import logging
+from typing import List, Optional, Sequence
+
+import pandas as pd
+
+from main import DataLoader, RunAnalysis, NON_WEIGHT_EXERCISES
+
+# Rows without a date are reported as 'unparseable_date' by DataLoader.validate_data and stored with a NULL date
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id INTEGER PRIMARY KEY,
+    date TEXT,
+    group_name TEXT,
+    training_minutes REAL
+);
+CREATE TABLE IF NOT EXISTS sets (
+    row_id INTEGER NOT NULL,
+    set_index INTEGER NOT NULL,
+    session_id INTEGER NOT NULL REFERENCES sessions(session_id),
+    date TEXT,
+    exercise TEXT,
+    variation TEXT,
+    weight REAL,
+    reps REAL,
+    PRIMARY KEY (row_id, set_index)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    row_id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(session_id),
+    date TEXT,
+    distance REAL,
+    total_seconds REAL,
+    speed REAL,
+    slope TEXT,
+    pace REAL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_date ON sessions(date);
+CREATE INDEX IF NOT EXISTS idx_sets_exercise ON sets(exercise, row_id, set_index);
+CREATE INDEX IF NOT EXISTS idx_sets_date ON sets(date);
+CREATE INDEX IF NOT EXISTS idx_runs_distance ON runs(distance, row_id);
+CREATE INDEX IF NOT EXISTS idx_runs_date ON runs(date);
+"""
+
+
+class TrainingStore:
+    def __init__(self, path: str = 'training.sqlite') -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA_SQL)
+        # Increased by every populate, the memoized analysis results depend on it
+        self.version = 0
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def populate(self, data: pd.DataFrame) -> None:
+        data = data.reset_index(drop=True)
+        dates = data['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+        # Sessions: one per date and group, in order of appearance
+        session_keys = pd.DataFrame({'date': dates, 'group_name': data['group']})
+        session_ids = session_keys.groupby(['date', 'group_name'], sort=False, dropna=False).ngroup()
+        sessions = session_keys.assign(session_id=session_ids,
+                                       training_minutes=data['training_time'].dt.total_seconds() / 60)
+        sessions = sessions.drop_duplicates('session_id')
+
+        # Sets: explode weight and reps separately and pair them by position within the row
+        def explode_sets(column: str) -> pd.DataFrame:
+            values = data[column].explode()
+            sets = pd.DataFrame({'row_id': values.index, column: pd.to_numeric(values.values, errors='coerce')})
+            sets['set_index'] = sets.groupby('row_id').cumcount()
+            return sets
+        sets = explode_sets('weight').merge(explode_sets('reps'), on=['row_id', 'set_index'], how='outer')
+        row_columns = pd.DataFrame({'session_id': session_ids, 'date': dates,
+                                    'exercise': data['exercise'], 'variation': data['variation']})
+        sets = sets.join(row_columns, on='row_id')
+
+        # Runs: reuse the pace calculation of RunAnalysis
+        running_data = RunAnalysis(data).running_data()
+        runs = pd.DataFrame({
+            'row_id': running_data.index,
+            'session_id': session_ids.loc[running_data.index].values,
+            'date': dates.loc[running_data.index].values,
+            'distance': running_data['distance'],
+            'total_seconds': running_data['total_time_delta'].dt.total_seconds(),
+            'speed': running_data['speed'],
+            'slope': running_data['slope'],
+            'pace': running_data['pace'],
+        })
+
+        # Recreate the tables, a store written with an older column layout is replaced as a whole.
+        # executescript would commit the drop on its own, one transaction keeps the old store when an insert fails
+        with self.connection:
+            self.connection.execute('BEGIN')
+            for statement in ['DROP TABLE IF EXISTS sets', 'DROP TABLE IF EXISTS runs',
+                              'DROP TABLE IF EXISTS sessions'] + SCHEMA_SQL.split(';'):
+                if statement.strip():
+                    self.connection.execute(statement)
+            self._insert('sessions', sessions[['session_id', 'date', 'group_name', 'training_minutes']])
+            self._insert('sets', sets[['row_id', 'set_index', 'session_id', 'date', 'exercise',
+                                       'variation', 'weight', 'reps']])
+            self._insert('runs', runs)
+        self.connection.execute('ANALYZE')
+        self.version += 1
+        logging.info(f"Stored {len(sessions)} sessions, {len(sets)} sets and {len(runs)} runs in {self.path}")
+
+    def _insert(self, table: str, frame: pd.DataFrame) -> None:
+        # Convert numpy scalars and NaN to plain python values understood by sqlite3
+        frame = frame.astype(object).where(frame.notnull(), None)
+        placeholders = ', '.join('?' * len(frame.columns))
+        self.connection.executemany(
+            f"INSERT INTO {table} ({', '.join(frame.columns)}) VALUES ({placeholders})",
+            frame.itertuples(index=False, name=None))
+
+    def query(self, sql: str, params: Sequence = (), parse_dates: Optional[List[str]] = None) -> pd.DataFrame:
+        return pd.read_sql_query(sql, self.connection, params=params, parse_dates=parse_dates)
+
+    def exercise_sets(self, exercise: str) -> pd.DataFrame:
+        return self.query(
+            """SELECT row_id, set_index, date, exercise, variation, weight, reps
+               FROM sets WHERE exercise = ? ORDER BY row_id, set_index""",
+            (exercise,), parse_dates=['date'])
+
+    def total_weight_lifted(self, last: int = 5, skip: int = 0) -> pd.DataFrame:
+        # Sum of weight * reps over the sets ranked skip+1 .. skip+last counted from the most recent set,
+        # every exercise reads only its own tail of the (exercise, row_id, set_index) index
+        return self.query(
+            """SELECT e.exercise,
+                      COALESCE((SELECT SUM(volume) FROM (
+                          SELECT weight * reps AS volume FROM sets s WHERE s.exercise = e.exercise
+                          ORDER BY row_id DESC, set_index DESC LIMIT ? OFFSET ?)), 0.0) AS total_weight_lifted
+               FROM (SELECT exercise, MIN(row_id) AS first_row FROM sets GROUP BY exercise) e
+               ORDER BY e.first_row""",
+            (last, skip))
+
+    def exercise_summary(self, exclude: Sequence[str] = NON_WEIGHT_EXERCISES) -> pd.DataFrame:
+        placeholders = ', '.join('?' * len(exclude))
+        return self.query(
+            f"""SELECT e.exercise, e.count, e.max_weight,
+                       (SELECT reps FROM sets s WHERE s.exercise = e.exercise AND s.weight = e.max_weight
+                        ORDER BY row_id, set_index LIMIT 1) AS max_weight_reps,
+                       e.average_weight,
+                       (SELECT AVG(weight) FROM (
+                           SELECT weight FROM sets s WHERE s.exercise = e.exercise
+                           ORDER BY row_id DESC, set_index DESC LIMIT 5)) AS average_weight_last_5_runs
+                FROM (SELECT exercise, MIN(row_id) AS first_row, COUNT(DISTINCT row_id) AS count,
+                             MAX(weight) AS max_weight, AVG(weight) AS average_weight
+                      FROM sets WHERE exercise NOT IN ({placeholders}) GROUP BY exercise) e
+                ORDER BY e.first_row""",
+            tuple(exclude))
+
+    def running_summary(self) -> pd.DataFrame:
+        running_summary = self.query(
+            """SELECT r.distance, r.count, r.min_pace, r.average_pace,
+                      (SELECT AVG(pace) FROM (
+                          SELECT pace FROM runs s WHERE s.distance = r.distance
+                          ORDER BY row_id DESC LIMIT 5)) AS average_pace_last_5_runs
+               FROM (SELECT distance, MIN(row_id) AS first_row, COUNT(*) AS count,
+                            MIN(pace) AS min_pace, AVG(pace) AS average_pace
+                     FROM runs GROUP BY distance) r
+               ORDER BY r.first_row""")
+        # The index is the position in the distances including the runs without one, as in RunAnalysis
+        return running_summary.loc[running_summary['distance'].notnull()]
+
+    def volume_per_group_per_month(self) -> pd.DataFrame:
+        # A session with the group 'Back + Chest' counts towards both groups
+        return self.query(
+            """WITH RECURSIVE split(session_id, group_name, rest) AS (
+                   SELECT session_id, '', COALESCE(group_name, 'No group') || '+' FROM sessions
+                   UNION ALL
+                   SELECT session_id, TRIM(SUBSTR(rest, 1, INSTR(rest, '+') - 1)), SUBSTR(rest, INSTR(rest, '+') + 1)
+                   FROM split WHERE rest <> '')
+               SELECT strftime('%Y-%m', s.date) AS month, split.group_name AS "group",
+                      SUM(s.weight * s.reps) AS volume, COUNT(*) AS sets
+               FROM sets s JOIN split ON split.session_id = s.session_id AND split.group_name <> ''
+               WHERE s.date IS NOT NULL
+               GROUP BY month, split.group_name ORDER BY month, split.group_name""")
+
+    def best_pace_per_season(self, distance: float = 5.0) -> pd.DataFrame:
+        # Meteorological seasons, December belongs to the winter of the next year
+        return self.query(
+            """SELECT CAST(strftime('%Y', date, '+1 month') AS INTEGER) AS year,
+                      CASE (CAST(strftime('%m', date) AS INTEGER) % 12) / 3
+                          WHEN 0 THEN 'Winter' WHEN 1 THEN 'Spring' WHEN 2 THEN 'Summer' ELSE 'Autumn' END AS season,
+                      MIN(pace) AS best_pace, COUNT(*) AS runs
+               FROM runs WHERE distance = ? AND pace IS NOT NULL AND date IS NOT NULL
+               GROUP BY year, season ORDER BY MIN(date)""",
+            (float(distance),))
+
+#%%
+if __name__ == "__main__":
+    # Build the store from data.xlsx
+    loader = DataLoader('Sports')
+    store = TrainingStore()
+    store.populate(loader.clean_data(loader.read_data()))
+    print(store.volume_per_group_per_month())
@@ -0,0 +1,291 @@
+""" Streaming aggregation over large CSV and Parquet exports of the Sports sheet.
+
+    The exports are read in chunks of a fixed number of rows and pass through a generator pipeline:
+    - read_chunks: the raw rows of one export, with the headers of the Sports sheet
+    - clean_chunks: the typed and cleaned rows, DataLoader.convert and DataLoader.clean_data per chunk,
+      the forward fill of the group and the date carries over from one chunk to the next,
+      the rows DataLoader.quarantine leaves out of the analysis are dropped
+    - the aggregators: ExerciseAggregator, GroupAggregator and RunningAggregator keep a fixed
+      amount of state per exercise, group and distance and produce the same tables as
+      ExerciseAnalysis.unique_exercise_data, ExerciseAnalysis.group_exercise_data and
+      RunAnalysis.unique_running_data on the whole history
+    Only one chunk is in memory at a time, so the peak memory depends on the chunk size and not
+    on the size of the exports.
+
+    The aggregators are mergeable: a.merge(b) equals a single aggregator that saw the rows of a
+    followed by the rows of b, so separate exports can be aggregated on their own and combined,
+    as long as every export starts with its own group and date for the forward fill.
+    The averages are summed chunk by chunk, they can differ from the pandas results in the last digits.
+
+    Run 'python streaming.py export-2022.csv export-2023.parquet' for the three tables.
+    """
+#%%
+import os
+import time
+import logging
+import argparse
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from main import DataLoader, ExerciseAnalysis, RunAnalysis, NON_WEIGHT_EXERCISES
+
+# The columns DataLoader.clean_data forward fills
+FORWARD_FILLED = ['group', 'date']
+
+
+def read_chunks(path: str, chunk_rows: int = 50_000) -> Iterator[pd.DataFrame]:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        # Everything as text, the converters of DataLoader parse the values
+        yield from pd.read_csv(path, chunksize=chunk_rows, dtype=object)
+    elif extension in ('.parquet', '.pq'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unknown export format {extension}, expected .csv or .parquet")
+
+
+def clean_chunks(paths: Iterable[str], loader: Optional[DataLoader] = None,
+                 chunk_rows: int = 50_000) -> Iterator[pd.DataFrame]:
+    # The exports are read one after the other as one long history
+    loader = loader or DataLoader('Sports')
+    rows = 0
+    carried: Dict[str, object] = {}
+    for path in paths:
+        for chunk in read_chunks(path, chunk_rows):
+            if chunk.empty:
+                continue
+            # Row numbers continue over the chunks and the exports
+            chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+            rows += len(chunk)
+            data = loader.convert(chunk)
+            if data.attrs['conversion_errors']:
+                logging.warning(f"{len(data.attrs['conversion_errors'])} cells of rows {chunk.index[0]}-"
+                                f"{chunk.index[-1]} in {path} could not be converted")
+            data = loader.clean_data(data)
+
+            # Rows at the start of the chunk continue the group and date of the previous chunk
+            for column in FORWARD_FILLED:
+                if column in carried:
+                    data[column] = data[column].fillna(carried[column])
+                filled = data[column].dropna()
+                if len(filled):
+                    carried[column] = filled.iloc[-1]
+            # After the forward fill, a dropped row may hold the group or date of the rows after it
+            yield loader.quarantine(data, loader.validate_data(data))
+
+
+class RunningAggregator:
+    def __init__(self) -> None:
+        # Distances in order of the first run, None stands for the runs without a distance
+        self.distances: Dict[Optional[float], None] = {}
+        self.counts: Dict[float, int] = {}
+        self.min_paces: Dict[float, float] = {}
+        self.pace_sums: Dict[float, float] = {}
+        self.pace_counts: Dict[float, int] = {}
+        self.last_paces: Dict[float, Deque[float]] = {}
+
+    def update(self, data: pd.DataFrame) -> None:
+        running_data = RunAnalysis(data, cache_size=0).running_data()
+        for distance in running_data['distance'].unique():
+            self.distances.setdefault(None if pd.isnull(distance) else float(distance), None)
+        for distance, paces in running_data.groupby('distance', sort=False)['pace']:
+            self._add(float(distance), len(paces), paces.min(), paces.sum(), int(paces.count()), paces.tail(5))
+
+    def _add(self, distance: float, count: int, min_pace: float, pace_sum: float, pace_count: int,
+             last_paces: Iterable[float]) -> None:
+        if distance not in self.counts:
+            self.counts[distance], self.min_paces[distance] = 0, np.nan
+            self.pace_sums[distance], self.pace_counts[distance] = 0.0, 0
+            self.last_paces[distance] = deque(maxlen=5)
+        self.counts[distance] += count
+        self.min_paces[distance] = np.fmin(self.min_paces[distance], min_pace)
+        self.pace_sums[distance] += pace_sum
+        self.pace_counts[distance] += pace_count
+        self.last_paces[distance].extend(last_paces)
+
+    def merge(self, other: 'RunningAggregator') -> 'RunningAggregator':
+        for distance in other.distances:
+            self.distances.setdefault(distance, None)
+        for distance in other.counts:
+            self._add(distance, other.counts[distance], other.min_paces[distance], other.pace_sums[distance],
+                      other.pace_counts[distance], other.last_paces[distance])
+        return self
+
+    def result(self) -> pd.DataFrame:
+        # The index is the position in the distances including the runs without one, as in RunAnalysis
+        rows = [(position, distance) for position, distance in enumerate(self.distances) if distance is not None]
+        unique_running_data = pd.DataFrame({
+            'distance': [distance for _, distance in rows],
+            'count': [self.counts[distance] for _, distance in rows],
+            'min_pace': [self.min_paces[distance] for _, distance in rows],
+            'average_pace': [self.pace_sums[distance] / self.pace_counts[distance] if self.pace_counts[distance]
+                             else np.nan for _, distance in rows],
+            'average_pace_last_5_runs': [pd.Series(self.last_paces[distance], dtype=float).mean()
+                                         for _, distance in rows],
+        }, index=[position for position, _ in rows])
+        unique_running_data['percentage_change'] = \
+            unique_running_data['average_pace'] / unique_running_data['average_pace_last_5_runs'] * 100
+        return RunAnalysis.running_summary_table(unique_running_data)
+
+
+class GroupAggregator:
+    def __init__(self) -> None:
+        # Single groups in order of appearance, 'Back + Chest' adds both 'Back' and 'Chest'
+        self.groups: Dict[str, None] = {}
+        # Rows per group as written in the sheet, the average weight is the mean of the rows' averages
+        self.counts: Dict[str, int] = {}
+        self.average_sums: Dict[str, float] = {}
+        self.last_averages: Dict[str, Deque[float]] = {}
+
+    def update(self, data: pd.DataFrame) -> None:
+        groups = data['group'].fillna('No group')
+        for group in groups.str.split('+').explode().str.strip().unique():
+            self.groups.setdefault(group, None)
+        averages = data['weight'].apply(lambda x: sum(x) / len(x))
+        for group, group_averages in averages.groupby(groups, sort=False):
+            self._add(group, len(group_averages), group_averages.sum(), group_averages.tail(5))
+
+    def _add(self, group: str, count: int, average_sum: float, last_averages: Iterable[float]) -> None:
+        if group not in self.counts:
+            self.counts[group], self.average_sums[group] = 0, 0.0
+            self.last_averages[group] = deque(maxlen=5)
+        self.counts[group] += count
+        self.average_sums[group] += average_sum
+        self.last_averages[group].extend(last_averages)
+
+    def merge(self, other: 'GroupAggregator') -> 'GroupAggregator':
+        for group in other.groups:
+            self.groups.setdefault(group, None)
+        for group in other.counts:
+            self._add(group, other.counts[group], other.average_sums[group], other.last_averages[group])
+        return self
+
+    def result(self) -> pd.DataFrame:
+        # A group only seen as part of a combination has no rows of its own
+        groups = list(self.groups)
+        group_exercise_data = pd.DataFrame({
+            'group': groups,
+            'count': [float(self.counts.get(group, 0)) for group in groups],
+            'average_weight': [self.average_sums[group] / self.counts[group] if self.counts.get(group) else np.nan
+                               for group in groups],
+            'average_weight_last_5': [pd.Series(self.last_averages[group], dtype=float).mean()
+                                      if group in self.counts else np.nan for group in groups],
+        })
+        group_exercise_data['growth_percentage'] = \
+            group_exercise_data['average_weight_last_5'] / group_exercise_data['average_weight'] * 100
+        return ExerciseAnalysis.group_summary_table(group_exercise_data)
+
+
+class ExerciseAggregator:
+    def __init__(self) -> None:
+        # All exercises in order of appearance, None stands for the rows without an exercise
+        self.exercises: Dict[Optional[str], None] = {}
+        self.counts: Dict[str, int] = {}
+        self.weight_sums: Dict[str, float] = {}
+        self.weight_counts: Dict[str, int] = {}
+        # Heaviest set and the reps of its first occurrence
+        self.max_weights: Dict[str, float] = {}
+        self.max_weight_reps: Dict[str, float] = {}
+        self.last_weights: Dict[str, Deque[float]] = {}
+        # Weight times reps of the last 10 sets, for the last 5 and the preceding 5
+        self.last_volumes: Dict[str, Deque[float]] = {}
+
+    def update(self, data: pd.DataFrame) -> None:
+        for exercise in data['exercise'].unique():
+            self.exercises.setdefault(None if pd.isnull(exercise) else exercise, None)
+        # One row per set, weight and reps are paired by position like in ExerciseAnalysis.weight_trend_data
+        sets = data[['exercise', 'weight', 'reps']].explode(['weight', 'reps'], ignore_index=True)
+        sets['weight'] = sets['weight'].astype(float)
+        sets['reps'] = sets['reps'].astype(float)
+        sets['volume'] = sets['weight'] * sets['reps']
+        row_counts = data['exercise'].value_counts(sort=False)
+        for exercise, exercise_sets in sets.groupby('exercise', sort=False):
+            weights = exercise_sets['weight']
+            max_weight = weights.max()
+            max_weight_reps = exercise_sets.loc[weights == max_weight, 'reps']
+            self._add(exercise, int(row_counts[exercise]), weights.sum(), int(weights.count()), max_weight,
+                      max_weight_reps.iloc[0] if len(max_weight_reps) else np.nan,
+                      weights.tail(5), exercise_sets['volume'].tail(10))
+
+    def _add(self, exercise: str, count: int, weight_sum: float, weight_count: int, max_weight: float,
+             max_weight_reps: float, last_weights: Iterable[float], last_volumes: Iterable[float]) -> None:
+        if exercise not in self.counts:
+            self.counts[exercise], self.weight_sums[exercise], self.weight_counts[exercise] = 0, 0.0, 0
+            self.max_weights[exercise], self.max_weight_reps[exercise] = np.nan, np.nan
+            self.last_weights[exercise], self.last_volumes[exercise] = deque(maxlen=5), deque(maxlen=10)
+        self.counts[exercise] += count
+        self.weight_sums[exercise] += weight_sum
+        self.weight_counts[exercise] += weight_count
+        # A later set only counts when it is strictly heavier, the reps belong to the first heaviest set
+        if np.isnan(self.max_weights[exercise]) or max_weight > self.max_weights[exercise]:
+            self.max_weights[exercise], self.max_weight_reps[exercise] = max_weight, max_weight_reps
+        self.last_weights[exercise].extend(last_weights)
+        self.last_volumes[exercise].extend(last_volumes)
+
+    def merge(self, other: 'ExerciseAggregator') -> 'ExerciseAggregator':
+        for exercise in other.exercises:
+            self.exercises.setdefault(exercise, None)
+        for exercise in other.counts:
+            self._add(exercise, other.counts[exercise], other.weight_sums[exercise], other.weight_counts[exercise],
+                      other.max_weights[exercise], other.max_weight_reps[exercise],
+                      other.last_weights[exercise], other.last_volumes[exercise])
+        return self
+
+    def _total_weight_lifted(self, skip: int) -> pd.DataFrame:
+        # Indexed by the position among all exercises, as ExerciseAnalysis.total_weight_lifted_last_5
+        totals = []
+        for exercise in self.exercises:
+            volumes = pd.Series(self.last_volumes.get(exercise, []), dtype=float)
+            # The preceding 5 are the last 10 minus the last 5, summed the same way as in ExerciseAnalysis
+            total = volumes.tail(5).sum() if skip == 0 else volumes.tail(10).sum() - volumes.tail(5).sum()
+            totals.append(total if exercise is not None else np.nan)
+        return pd.DataFrame({'exercise': [np.nan if e is None else e for e in self.exercises],
+                             'total_weight_lifted': totals})
+
+    def result(self) -> pd.DataFrame:
+        exercises = [exercise for exercise in self.exercises if exercise not in NON_WEIGHT_EXERCISES]
+        for exercise in exercises:
+            if exercise not in self.counts or np.isnan(self.max_weights[exercise]):
+                logging.warning(f"Could not determine the max weight of {exercise}: no sets with a weight")
+        unique_exercise_data = pd.DataFrame({
+            'exercise': [np.nan if exercise is None else exercise for exercise in exercises],
+            'count': [float(self.counts.get(exercise, 0)) for exercise in exercises],
+            'max_weight': [self.max_weights.get(exercise, np.nan) for exercise in exercises],
+            'max_weight_reps': [self.max_weight_reps.get(exercise, np.nan) for exercise in exercises],
+            'average_weight': [self.weight_sums[exercise] / self.weight_counts[exercise]
+                               if self.weight_counts.get(exercise) else np.nan for exercise in exercises],
+            'average_weight_last_5_runs': [pd.Series(self.last_weights.get(exercise, []), dtype=float).mean()
+                                           for exercise in exercises],
+        })
+        return ExerciseAnalysis.exercise_summary_table(unique_exercise_data, self._total_weight_lifted(skip=0),
+                                                       self._total_weight_lifted(skip=5))
+
+
+def stream_tables(paths: List[str], chunk_rows: int = 50_000,
+                  loader: Optional[DataLoader] = None) -> Dict[str, pd.DataFrame]:
+    aggregators = {'unique_exercise_data': ExerciseAggregator(), 'group_exercise_data': GroupAggregator(),
+                   'unique_running_data': RunningAggregator()}
+    start = time.perf_counter()
+    rows = 0
+    for data in clean_chunks(paths, loader, chunk_rows):
+        for aggregator in aggregators.values():
+            aggregator.update(data)
+        rows += len(data)
+    logging.info(f"Aggregated {rows} rows of {len(paths)} exports in {time.perf_counter() - start:.1f} s")
+    return {name: aggregator.result() for name, aggregator in aggregators.items()}
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='CSV or Parquet exports in chronological order')
+    parser.add_argument('--chunk-rows', type=int, default=50_000)
+    args = parser.parse_args()
+
+    for name, table in stream_tables(args.paths, args.chunk_rows).items():
+        print(f'\n{name}')
+        print(table.to_string())